@@ -0,0 +1,24 @@
+import importlib.util
+import os
+import platform
+import sqlite3
+import subprocess
+
+def percentile(values, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+def environment() -> dict:
+    # чтобы отчеты разных коммитов и машин можно было сравнивать
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'numpy': importlib.util.find_spec('numpy') is not None,
+        'machine': platform.machine(),
+    }
@@ -0,0 +1,148 @@
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter, deque
+from aiohttp import web
+
+# Локальная замена api.telegram.org для нагрузочных тестов. Понимает адреса
+# вида /bot<token>/<method> (как TelegramAPIServer.from_base) и реализует то,
+# что нужно боту: getUpdates (long polling), sendMessage, editMessageText,
+# answerCallbackQuery. На исходящих методах можно включить задержку, ошибки
+# и 429 с retry_after.
+
+BOT_USER = {'id': 42, 'is_bot': True, 'first_name': 'PetPet', 'username': 'petpet_bot'}
+MAX_UPDATES = 100
+OUTGOING = {'sendmessage', 'editmessagetext', 'answercallbackquery'}
+
+class FakeTelegram():
+    def __init__(self, latency: float = 0.0, jitter: float = 0.5, error_rate: float = 0.0,
+                 flood_rate: float = 0.0, retry_after: int = 1):
+        self.latency = latency          # средняя задержка ответа, секунд
+        self.jitter = jitter            # разброс задержки, доля от latency
+        self.error_rate = error_rate    # доля ответов 500
+        self.flood_rate = flood_rate    # доля ответов 429
+        self.retry_after = retry_after
+        self.requests = Counter()
+        self.injected = Counter()
+        self.polls = 0
+        self._pending = deque()
+        self._new_updates = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._waiters = {}  # chat_id -> Future первого ответа бота в этот чат
+        self._runner = None
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        return app
+
+    async def start(self, host: str, port: int):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    ## MARK: Client side
+    def push_update(self, kind: str, payload: dict) -> int:
+        update_id = next(self._update_ids)
+        self._pending.append({'update_id': update_id, kind: payload})
+        self._new_updates.set()
+        return update_id
+
+    def expect_reply(self, chat_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id] = future
+        return future
+
+    def next_message_id(self) -> int:
+        return next(self._message_ids)
+
+    def stats(self) -> dict:
+        return {
+            'requests': dict(self.requests),
+            'injected': dict(self.injected),
+            'polls': self.polls,
+            'pending_updates': len(self._pending),
+        }
+    ## MARK END: Client side
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        self.requests[method] += 1
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        if method in OUTGOING:
+            failure = await self._inject()
+            if failure is not None:
+                return failure
+        if method == 'getupdates':
+            return self._ok(await self._get_updates(params))
+        if method in ('sendmessage', 'editmessagetext'):
+            return self._ok(self._reply(params))
+        if method == 'getme':
+            return self._ok(BOT_USER)
+        return self._ok(True)
+
+    async def _inject(self):
+        if self.latency:
+            await asyncio.sleep(max(0.0, random.uniform(1 - self.jitter, 1 + self.jitter) * self.latency))
+        roll = random.random()
+        if roll < self.flood_rate:
+            self.injected['429'] += 1
+            return web.json_response({'ok': False, 'error_code': 429,
+                                      'description': f'Too Many Requests: retry after {self.retry_after}',
+                                      'parameters': {'retry_after': self.retry_after}}, status=429)
+        if roll < self.flood_rate + self.error_rate:
+            self.injected['500'] += 1
+            return web.json_response({'ok': False, 'error_code': 500, 'description': 'Internal Server Error'},
+                                     status=500)
+        return None
+
+    async def _get_updates(self, params: dict) -> list:
+        self.polls += 1
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        limit = int(params.get('limit') or MAX_UPDATES)
+        # offset подтверждает все апдейты до него
+        while self._pending and self._pending[0]['update_id'] < offset:
+            self._pending.popleft()
+        if not self._pending and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self._pending, limit))
+
+    def _reply(self, params: dict) -> dict:
+        chat_id = int(params['chat_id'])
+        message = {
+            'message_id': int(params.get('message_id') or next(self._message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            'text': params.get('text', ''),
+        }
+        markup = params.get('reply_markup')
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        # в Message бывает только inline клавиатура
+        if markup and 'inline_keyboard' in markup:
+            message['reply_markup'] = markup
+        waiter = self._waiters.pop(chat_id, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(message)
+        return message
+
+    @staticmethod
+    def _ok(result) -> web.Response:
+        return web.json_response({'ok': True, 'result': result})
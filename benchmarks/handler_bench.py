@@ -0,0 +1,214 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.base import BaseSession
+from aiogram.enums import ParseMode
+from aiogram.methods import EditMessageText, SendMessage
+from aiogram.types import Chat, Message, Update
+from aiogram.utils.callback_answer import CallbackAnswerMiddleware
+from modules.handlers.handlers import router
+from modules.libraries import async_database, database
+from modules.libraries.cache import pet_cache
+from modules.libraries.fsm_storage import SQLiteStorage
+from common import environment, percentile
+
+# Задержки хендлеров на настоящем роутере: синтетические апдейты идут через
+# Dispatcher.feed_update, запросы к Bot API отвечает заглушка сессии.
+#   python benchmarks/handler_bench.py --iterations 500 --max-p95 feed_callback=5
+#   python benchmarks/handler_bench.py --baseline handlers.json --tolerance 0.3
+# Код выхода 1, если хендлер вышел за порог.
+
+ITERATIONS = 300
+WARMUP = 20
+TOLERANCE = 0.25
+BOT_TOKEN = '42:BENCHMARK'
+FIRST_USER_ID = 10 ** 6
+
+# Сценарий одной итерации, у каждого пользователя свой питомец без кулдаунов
+SCENARIOS = ['status', 'feed', 'feed_callback', 'play', 'game_choice', 'math_answer']
+
+class StubSession(BaseSession):
+    # Сессия без сети: на отправку и редактирование возвращает сообщение,
+    # на остальные методы - True
+    def __init__(self):
+        super().__init__()
+        self.requests = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests[type(method).__name__] += 1
+        if isinstance(method, (SendMessage, EditMessageText)):
+            return Message(message_id=getattr(method, 'message_id', None) or next(self._message_ids), date=datetime.now(),
+                           chat=Chat(id=method.chat_id or 0, type='private'), text=method.text)
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b''
+
+    async def close(self):
+        pass
+
+class UpdateFactory():
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': 'bench'}
+
+    def _chat(self, user_id: int) -> dict:
+        return {'id': user_id, 'type': 'private'}
+
+    def _validate(self, update: dict) -> Update:
+        # привязка к боту заранее, чтобы feed_update не пересобирал апдейт
+        return Update.model_validate(update, context={'bot': self.bot})
+
+    def message(self, user_id: int, text: str) -> Update:
+        update_id = next(self._update_ids)
+        return self._validate({'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': int(time.time()), 'text': text,
+            'chat': self._chat(user_id), 'from': self._user(user_id)}})
+
+    def callback(self, user_id: int, data: str) -> Update:
+        update_id = next(self._update_ids)
+        return self._validate({'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'chat_instance': str(user_id), 'data': data,
+            'from': self._user(user_id),
+            'message': {'message_id': update_id, 'date': int(time.time()), 'text': '...',
+                        'chat': self._chat(user_id), 'from': {'id': 42, 'is_bot': True, 'first_name': 'PetPet'}}}})
+
+async def iteration(dp: Dispatcher, bot: Bot, factory: UpdateFactory, user_id: int):
+    # По апдейту на сценарий; отдает (сценарий, апдейт) по одному, ответ на
+    # задачу берется из FSM после выбора игры.
+    yield 'status', factory.message(user_id, "🔍 Статус")
+    yield 'feed', factory.message(user_id, "🍽 Покормить")
+    yield 'feed_callback', factory.callback(user_id, "feed_Яблоко")
+    yield 'play', factory.message(user_id, "🎮 Поиграть")
+    yield 'game_choice', factory.callback(user_id, "play_Математика")
+    data = await dp.fsm.get_context(bot=bot, chat_id=user_id, user_id=user_id).get_data()
+    yield 'math_answer', factory.message(user_id, str(data.get('correct_answer')))
+
+async def run_pass(dp: Dispatcher, bot: Bot, factory: UpdateFactory, user_ids, trace_allocations: bool):
+    timings = {name: [] for name in SCENARIOS}
+    allocations = {name: [] for name in SCENARIOS}
+    for user_id in user_ids:
+        async for name, update in iteration(dp, bot, factory, user_id):
+            if trace_allocations:
+                tracemalloc.reset_peak()
+                before, _ = tracemalloc.get_traced_memory()
+                await dp.feed_update(bot, update)
+                _, peak = tracemalloc.get_traced_memory()
+                allocations[name].append(peak - before)
+            else:
+                started = time.perf_counter()
+                await dp.feed_update(bot, update)
+                timings[name].append(time.perf_counter() - started)
+    return timings, allocations
+
+async def run(iterations: int, warmup: int, directory: str) -> dict:
+    database.init_db(os.path.join(directory, 'bench.db'))
+    session = StubSession()
+    bot = Bot(token=BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    storage = SQLiteStorage()
+    dp = Dispatcher(storage=storage)
+    dp.include_router(router)
+    dp.callback_query.middleware(CallbackAnswerMiddleware())
+    pet_cache.start()
+
+    # у каждой итерации свой питомец: прогрев, замер задержек, замер аллокаций
+    user_ids = list(range(FIRST_USER_ID, FIRST_USER_ID + warmup + 2 * iterations))
+    for user_id in user_ids:
+        await async_database.create_pet(user_id, f'pet{user_id}')
+    factory = UpdateFactory(bot)
+    try:
+        await run_pass(dp, bot, factory, user_ids[:warmup], False)
+        timings, _ = await run_pass(dp, bot, factory, user_ids[warmup:warmup + iterations], False)
+        tracemalloc.start()
+        try:
+            _, allocations = await run_pass(dp, bot, factory, user_ids[warmup + iterations:], True)
+        finally:
+            tracemalloc.stop()
+    finally:
+        await pet_cache.close()
+        await storage.close()
+        await bot.session.close()
+        async_database.shutdown()
+        database.close_db()
+
+    results = {}
+    for name in SCENARIOS:
+        results[name] = {
+            'count': len(timings[name]),
+            'p50_ms': round(percentile(timings[name], 0.50) * 1000, 3),
+            'p95_ms': round(percentile(timings[name], 0.95) * 1000, 3),
+            'p99_ms': round(percentile(timings[name], 0.99) * 1000, 3),
+            'max_ms': round(max(timings[name], default=0.0) * 1000, 3),
+            'alloc_peak_kb_mean': round(sum(allocations[name]) / max(1, len(allocations[name])) / 1024, 2),
+            'alloc_peak_kb_max': round(max(allocations[name], default=0) / 1024, 2),
+        }
+    return {'results': results, 'api_requests': dict(session.requests)}
+
+def check_thresholds(results: dict, max_p95: dict, baseline: dict, tolerance: float):
+    failures = []
+    for name, limit in max_p95.items():
+        if name in results and results[name]['p95_ms'] > limit:
+            failures.append(f"{name}: p95 {results[name]['p95_ms']} ms > {limit} ms")
+    for name, previous in baseline.items():
+        if name in results and results[name]['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            failures.append(f"{name}: p95 {results[name]['p95_ms']} ms vs baseline {previous['p95_ms']} ms "
+                            f"(+{tolerance:.0%} allowed)")
+    return failures
+
+def parse_limit(value: str):
+    name, _, limit = value.partition('=')
+    if name not in SCENARIOS or not limit:
+        raise argparse.ArgumentTypeError(f"expected SCENARIO=MS with SCENARIO in {', '.join(SCENARIOS)}")
+    return name, float(limit)
+
+def main():
+    parser = argparse.ArgumentParser(description='PetPet handler latency benchmark')
+    parser.add_argument('--iterations', type=int, default=ITERATIONS)
+    parser.add_argument('--warmup', type=int, default=WARMUP)
+    parser.add_argument('--max-p95', type=parse_limit, action='append', default=[], metavar='SCENARIO=MS',
+                        help='fail when the p95 latency of a scenario exceeds MS')
+    parser.add_argument('--baseline', help='JSON report of a previous run to compare p95 against')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='allowed p95 growth over the baseline, as a fraction')
+    parser.add_argument('--output', help='write JSON results to this file')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    with tempfile.TemporaryDirectory() as directory:
+        measured = asyncio.run(run(args.iterations, args.warmup, directory))
+    report = dict({'benchmark': 'handlers', 'environment': environment(), 'iterations': args.iterations}, **measured)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    print(json.dumps(report, indent=2))
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+    failures = check_thresholds(report['results'], dict(args.max_p95), baseline, args.tolerance)
+    for failure in failures:
+        print(f"REGRESSION {failure}", file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from common import environment, percentile
+from fake_telegram import FakeTelegram
+
+# Сквозной нагрузочный тест: поднимает фейковый Bot API и изображает
+# пользователей, которые жмут кнопки главной клавиатуры. Бот запускается
+# отдельно и ходит в фейковый сервер:
+#   python benchmarks/load_test.py --port 8081 --users 2000 --duration 60 --latency 0.05
+#   PETPET_API_URL=http://127.0.0.1:8081 PETPET_TOKEN=42:LOAD PETPET_DB=/tmp/load.db python main.py
+# Задержка действия - от появления апдейта в getUpdates до первого ответа бота в этот чат.
+
+HOST = '127.0.0.1'
+PORT = 8081
+USERS = 1000
+DURATION = 60
+THINK_TIME = 2.0      # средняя пауза пользователя между действиями, секунд
+REPLY_TIMEOUT = 15
+BOT_WAIT = 60         # сколько ждать первого getUpdates от бота
+
+# кнопки get_main_keyboard() в handlers.py
+BUTTONS = ["🔍 Статус", "🍽 Покормить", "🚿 Помыть", "🎮 Поиграть", "😴 Уложить спать", "📚 Учить трюк"]
+
+class LoadStats():
+    def __init__(self):
+        self.latencies = {}
+        self.timeouts = {}
+
+    def record(self, action: str, latency):
+        if latency is None:
+            self.timeouts[action] = self.timeouts.get(action, 0) + 1
+        else:
+            self.latencies.setdefault(action, []).append(latency)
+
+    def report(self, elapsed: float) -> dict:
+        completed = sum(len(values) for values in self.latencies.values())
+        actions = {}
+        for action in sorted(set(self.latencies) | set(self.timeouts)):
+            values = self.latencies.get(action, [])
+            actions[action] = {
+                'completed': len(values),
+                'timeouts': self.timeouts.get(action, 0),
+                'p50_ms': round(percentile(values, 0.50) * 1000, 1),
+                'p95_ms': round(percentile(values, 0.95) * 1000, 1),
+                'p99_ms': round(percentile(values, 0.99) * 1000, 1),
+                'max_ms': round(max(values, default=0.0) * 1000, 1),
+            }
+        return {
+            'elapsed_s': round(elapsed, 2),
+            'completed': completed,
+            'timeouts': sum(self.timeouts.values()),
+            'throughput_per_s': round(completed / elapsed, 1) if elapsed else None,
+            'actions': actions,
+        }
+
+class SimulatedUser():
+    def __init__(self, server: FakeTelegram, user_id: int, stats: LoadStats, reply_timeout: float):
+        self.server = server
+        self.user_id = user_id
+        self.stats = stats
+        self.reply_timeout = reply_timeout
+        self.profile = {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+        self.chat = {'id': user_id, 'type': 'private'}
+
+    async def _exchange(self, action: str, kind: str, payload: dict):
+        reply = self.server.expect_reply(self.user_id)
+        started = time.perf_counter()
+        self.server.push_update(kind, payload)
+        try:
+            message = await asyncio.wait_for(reply, self.reply_timeout)
+        except asyncio.TimeoutError:
+            self.stats.record(action, None)
+            return None
+        self.stats.record(action, time.perf_counter() - started)
+        return message
+
+    async def send(self, action: str, text: str):
+        return await self._exchange(action, 'message', {
+            'message_id': self.server.next_message_id(), 'date': int(time.time()),
+            'chat': self.chat, 'from': self.profile, 'text': text})
+
+    async def press(self, action: str, message: dict, data: str):
+        return await self._exchange(action, 'callback_query', {
+            'id': f'{self.user_id}:{message["message_id"]}', 'chat_instance': str(self.user_id),
+            'from': self.profile, 'message': message, 'data': data})
+
+    async def run(self, stop_at: float, think_time: float):
+        reply = await self.send('/start', '/start')
+        if reply is not None and 'назвать' in reply['text']:
+            await self.send('create', f'Pet{self.user_id}')
+        while time.monotonic() < stop_at:
+            await asyncio.sleep(random.expovariate(1 / think_time))
+            button = random.choice(BUTTONS)
+            reply = await self.send(button, button)
+            keyboard = (reply or {}).get('reply_markup', {}).get('inline_keyboard')
+            if keyboard:
+                choice = random.choice([key for row in keyboard for key in row])
+                await self.press(f'{button} → {choice["text"]}', reply, choice['callback_data'])
+
+async def run(args) -> dict:
+    server = FakeTelegram(latency=args.latency, error_rate=args.error_rate,
+                          flood_rate=args.flood_rate, retry_after=args.retry_after)
+    await server.start(args.host, args.port)
+    print(f"fake Bot API on http://{args.host}:{args.port}, waiting for the bot...", file=sys.stderr)
+    try:
+        waited = time.monotonic()
+        while not server.polls:
+            if time.monotonic() - waited > args.bot_wait:
+                raise SystemExit("the bot never called getUpdates; is PETPET_API_URL set?")
+            await asyncio.sleep(0.1)
+
+        stats = LoadStats()
+        started = time.monotonic()
+        stop_at = started + args.duration
+        users = [SimulatedUser(server, args.first_user_id + index, stats, args.reply_timeout)
+                 for index in range(args.users)]
+        await asyncio.gather(*(user.run(stop_at, args.think_time) for user in users))
+        report = stats.report(time.monotonic() - started)
+    finally:
+        await server.close()
+    return dict({'benchmark': 'load', 'environment': environment(), 'users': args.users,
+                 'latency': args.latency, 'error_rate': args.error_rate, 'flood_rate': args.flood_rate,
+                 'server': server.stats()}, **report)
+
+def main():
+    parser = argparse.ArgumentParser(description='PetPet end-to-end load test against a fake Bot API')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--users', type=int, default=USERS)
+    parser.add_argument('--first-user-id', type=int, default=10 ** 7)
+    parser.add_argument('--duration', type=float, default=DURATION)
+    parser.add_argument('--think-time', type=float, default=THINK_TIME)
+    parser.add_argument('--reply-timeout', type=float, default=REPLY_TIMEOUT)
+    parser.add_argument('--bot-wait', type=float, default=BOT_WAIT)
+    parser.add_argument('--latency', type=float, default=0.0, help='mean Bot API response latency, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of outgoing calls answered with 500')
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='share of outgoing calls answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--output', help='write JSON results to this file')
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2, ensure_ascii=False)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+if __name__ == '__main__':
+    main()
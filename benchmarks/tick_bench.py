@@ -0,0 +1,197 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.libraries import async_database, database, tick
+from modules.libraries.constant import const
+from modules.libraries.notifier import Notifier
+from modules.libraries.personality import PERSONALITY_NAMES
+from common import environment, percentile
+
+# Нагрузочный прогон часового тика на синтетической базе.
+#   python benchmarks/tick_bench.py --pets 1000 100000 1000000 --output tick.json
+# Каждый размер считается в отдельном процессе, чтобы пиковый RSS был честным.
+
+SIZES = [1000, 10000, 100000]
+ACTIVE_SHARE = 0.5
+INSERT_CHUNK = 50000
+LAG_INTERVAL = 0.01  # шаг монитора блокировок event loop
+
+class FakeBot():
+    # вместо Telegram: отправка ничего не стоит, только считается
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        self.sent += 1
+
+class LoopLagMonitor():
+    # Спит по LAG_INTERVAL и считает, насколько просыпается позже: это время,
+    # когда event loop был занят и не мог обработать апдейты.
+    def __init__(self, interval: float = LAG_INTERVAL):
+        self.interval = interval
+        self.max_lag = 0.0
+        self.blocked = 0.0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = loop.time() - started - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.interval:
+                self.blocked += lag
+
+def generate_pets(path: str, pets: int, active_share: float = ACTIVE_SHARE, seed: int = 0):
+    database.init_db(path)
+    rng = random.Random(seed)
+    now = time.time()
+    def rows():
+        for user_id in range(1, pets + 1):
+            active = rng.random() < active_share
+            # активные трогали питомца в пределах окна, остальные - давно
+            seen = now - rng.uniform(0, const.ACTIVE_WINDOW) if active else now - rng.uniform(2, 30) * const.ACTIVE_WINDOW
+            seen = int(seen)
+            yield (user_id, f'pet{user_id}', rng.choice(PERSONALITY_NAMES),
+                   *(rng.randint(const.MIN_STAT, const.MAX_STAT) for _ in const.NEWSTATS),
+                   seen, seen, seen, seen,
+                   int(now) - rng.randint(0, 5 * const.TICK_PERIOD), database.tick_slot_for(user_id))
+    query = (f'INSERT INTO pets (user_id, name, personality, {", ".join(const.NEWSTATS)}, '
+             'last_fed, last_cleaned, last_played, last_slept, last_tick, tick_slot) '
+             f'VALUES ({", ".join("?" * (9 + len(const.NEWSTATS)))})')
+    source = rows()
+    while True:
+        chunk = [row for _, row in zip(range(INSERT_CHUNK), source)]
+        if not chunk:
+            break
+        with database.get_pool().writer() as conn:
+            conn.executemany(query, chunk)
+
+async def run_tick(mode: str):
+    bot = FakeBot()
+    notifier = Notifier(bot, global_rate=1e9, chat_rate=1e9, chat_burst=10 ** 9, max_queue=0)
+    notifier.start()
+    monitor = LoopLagMonitor()
+    monitor.start()
+
+    writes = 0
+    run_write = async_database.run_write
+    async def counting_run_write(fn, *args, **kwargs):
+        nonlocal writes
+        writes += 1
+        return await run_write(fn, *args, **kwargs)
+    async_database.run_write = counting_run_write
+
+    with database.get_pool().writer() as conn:
+        changes_before = conn.total_changes
+    slot_times = []
+    events = 0
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    try:
+        if mode == 'full':
+            # весь активный парк одной пачкой, у каждого питомца событие
+            user_ids = []
+            for tick_slot in range(const.TICK_SLOTS):
+                user_ids += await async_database.get_active_user_ids(tick_slot)
+            event_ids = [random.randrange(len(tick.EVENTS)) for _ in user_ids]
+            events = await async_database.run_write(tick.apply_events, user_ids, event_ids)
+        else:
+            # один оборот колеса: все слоты подряд, без пауз между ними
+            for tick_slot in range(const.TICK_SLOTS):
+                slot_started = time.perf_counter()
+                events += await tick.process_tick_slot(notifier, tick_slot)
+                slot_times.append(time.perf_counter() - slot_started)
+    finally:
+        async_database.run_write = run_write
+    wall = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    with database.get_pool().writer() as conn:
+        rows_written = conn.total_changes - changes_before
+
+    await notifier.close(timeout=0)
+    await monitor.close()
+    return {
+        'wall_s': round(wall, 4),
+        'cpu_s': round(cpu, 4),
+        'events': events,
+        'rows_per_s': round(events / wall, 1) if wall else None,
+        'db_rows_written': rows_written,
+        'db_write_batches': writes,
+        'slot_p50_ms': round(percentile(slot_times, 0.5) * 1000, 3) if slot_times else None,
+        'slot_max_ms': round(max(slot_times) * 1000, 3) if slot_times else None,
+        'loop_max_lag_ms': round(monitor.max_lag * 1000, 3),
+        'loop_blocked_ms': round(monitor.blocked * 1000, 3),
+        'notifications_queued': notifier.queue.qsize() + bot.sent,
+    }
+
+def run_size(pets: int, mode: str, active_share: float) -> dict:
+    logging.disable(logging.WARNING)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        started = time.perf_counter()
+        generate_pets(path, pets, active_share)
+        generate_time = time.perf_counter() - started
+        try:
+            result = asyncio.run(run_tick(mode))
+        finally:
+            async_database.shutdown()
+            database.close_db()
+    # ru_maxrss в килобайтах на Linux и в байтах на macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss //= 1024
+    return dict({'pets': pets, 'mode': mode, 'active_share': active_share,
+                 'generate_s': round(generate_time, 2), 'peak_rss_kb': peak_rss}, **result)
+
+def main():
+    parser = argparse.ArgumentParser(description='PetPet tick benchmark')
+    parser.add_argument('--pets', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--mode', choices=['slots', 'full'], default='slots')
+    parser.add_argument('--active', type=float, default=ACTIVE_SHARE, help='share of pets active within the window')
+    parser.add_argument('--output', help='write JSON results to this file')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_size(args.pets[0], args.mode, args.active)))
+        return
+
+    results = []
+    for pets in args.pets:
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', '--pets', str(pets),
+                                '--mode', args.mode, '--active', str(args.active)],
+                               capture_output=True, text=True)
+        if child.returncode:
+            sys.stderr.write(child.stderr)
+            sys.exit(child.returncode)
+        results.append(json.loads(child.stdout.splitlines()[-1]))
+        print(f"{pets:>9} pets: tick {results[-1]['wall_s']}s, {results[-1]['rows_per_s']} rows/s, "
+              f"peak RSS {results[-1]['peak_rss_kb'] // 1024} MB", file=sys.stderr)
+    report = {'benchmark': 'tick', 'environment': environment(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
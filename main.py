@@ -3,22 +3,55 @@ import asyncio
 import logging
 import os
 import sys
-import random
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.utils.callback_answer import CallbackAnswerMiddleware
 from modules.handlers.handlers import router
-from modules.libraries.database import init_db, get_all_pets, update_pet
+from modules.libraries.database import init_db, close_db
+from modules.libraries.async_database import shutdown as shutdown_db_executors
+from modules.libraries.scheduler import TimeWheel
+from modules.libraries.notifier import Notifier
+from modules.libraries.cache import pet_cache
+from modules.libraries.timers import timer_service
+from modules.libraries.leaderboard import leaderboard
+from modules.libraries.fsm_storage import SQLiteStorage
+from modules.libraries.webhook import WebhookServer, UpdateProcessor, MAX_IN_FLIGHT
+from modules.libraries.sharding import Supervisor, iter_updates
+from modules.libraries.metrics import metrics, MetricsMiddleware, ApiTimer, SUMMARY_INTERVAL
+from modules.libraries import tracing
 from datetime import datetime, timedelta
 from modules.libraries.constant import const
+from modules.libraries.tick import process_tick_slot
 if os.name == 'nt':  ## MARK: CHANGE TOKEN 
     TOKEN_FILE_PATH = 'C:/2501/petpet/data/TOKEN'
 else:
     TOKEN_FILE_PATH = '/home/syra/2501/tg_bots/petpet/TOKEN'
 LOGGING_PATH = './logs'
 
+# Режим работы: 'polling' (по умолчанию) или 'webhook'
+BOT_MODE = os.environ.get('PETPET_MODE', 'polling')
+WEBHOOK_HOST = os.environ.get('PETPET_WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.environ.get('PETPET_WEBHOOK_PORT', 8080))
+WEBHOOK_PATH = os.environ.get('PETPET_WEBHOOK_PATH', '/webhook')
+WEBHOOK_URL = os.environ.get('PETPET_WEBHOOK_URL')  # публичный адрес; без него вебхук не регистрируется (локальная отладка)
+WEBHOOK_SECRET = os.environ.get('PETPET_WEBHOOK_SECRET')
+WEBHOOK_MAX_IN_FLIGHT = int(os.environ.get('PETPET_WEBHOOK_MAX_IN_FLIGHT', MAX_IN_FLIGHT))
+# Больше одного - режим супервизора: апдейты раздаются процессам-воркерам по user_id
+WORKERS = int(os.environ.get('PETPET_WORKERS', 1))
+# Свой сервер Bot API, например фейковый из benchmarks/fake_telegram.py для нагрузочных тестов
+API_URL = os.environ.get('PETPET_API_URL')
+DATABASE_PATH = os.environ.get('PETPET_DB')
+# /metrics в формате Prometheus; без порта не поднимается. Воркер N слушает порт + N
+METRICS_HOST = os.environ.get('PETPET_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('PETPET_METRICS_PORT', 0))
+METRICS_SUMMARY_INTERVAL = float(os.environ.get('PETPET_METRICS_SUMMARY_INTERVAL', SUMMARY_INTERVAL))
+# Трассировка SQL: время по формам запросов и лог медленных с планом выполнения
+SQL_TRACE = os.environ.get('PETPET_SQL_TRACE') == '1'
+SLOW_QUERY_MS = float(os.environ.get('PETPET_SLOW_QUERY_MS', tracing.SLOW_QUERY_MS))
+
 def read_token_from_file(file_path):
     try:
         with open(file_path, 'r') as file:
@@ -27,79 +60,154 @@ def read_token_from_file(file_path):
     except Exception as e:
         raise ValueError(f"Error reading token from file: {e}")
 
-TOKEN = read_token_from_file(TOKEN_FILE_PATH)
+TOKEN = os.environ.get('PETPET_TOKEN') or read_token_from_file(TOKEN_FILE_PATH)
 if not TOKEN:
     raise ValueError("No BOT_TOKEN found in the token file. Please check your token.")
 
-async def notify_user(user_id: int, event: str, bot: Bot):
-    try:
-        await bot.send_message(user_id, f"🎉 Событие у твоего питомца!\n\n{event}")
-    except TelegramAPIError:
-        logging.error(f"Failed to send notification to user {user_id}")
-
-async def periodic_update(bot: Bot):
-    while True:
-        pets = get_all_pets()
-        for pet in pets:
-            updates = {}
-            for stat in const.STATS:
-                if stat in ['hunger', 'energy']:
-                    updates[stat] = min(const.MAX_STAT, pet[stat] + const.STAT_DECAY_RATE)
-                else:
-                    updates[stat] = max(const.MIN_STAT, pet[stat] - const.STAT_DECAY_RATE)
-            if random.random() < 0.3:  # дефолт: 30% шанс
-                event, effect = random_event()
-                updates.update(effect)
-                await notify_user(pet['user_id'], event, bot)
-            update_pet(pet['user_id'], **updates)
-            logging.info(f"update_pet >> {pet['user_id']} {updates}")
-        await asyncio.sleep(3600) # дефолт: 3600
-
-def random_event():
-    events = [
-        ("Твой питомец нашел вкусняшку.\nОн насытился и стал немного счастливее!", {'hunger': -10, 'happiness': 10}),
-        ("Твой питомец поиграл с соседским питомцем.\nОн немного устал, но стал счастливее!", {'energy': -10, 'happiness': 15}),
-        ("Твой питомец научился новому трюку.\nОн стал умнее, но устал!", {'intelligence': 10, 'energy': -5}),
-        ("Твой питомец испугался громкого звука.\nЕму стало грустно!", {'happiness': -10, 'energy': 5}),
-        ("Твой питомец поспал на солнышке.\nОн испачкался, но выспался!", {'energy': 15, 'cleanliness': -5}),
-        ("Твой питомец нашел интересную книгу.\nНе поняв ни слова он стал немного умнее и счатливее!", {'intelligence': 15, 'happiness': 5}),
-        ("Твой питомец устроил беспорядок.\nОн испачкался, но стал немного счастливее!", {'cleanliness': -15, 'happiness': 5}),
-        ("Твой питомец помог соседу и получил награду.\nОн устал, но стал счастливее!", {'happiness': 20, 'energy': -10}),
-        ("Твой питомец участвовал в местном конкурсе талантов и выиграл.\nОн стал умнее и счастливее, хоть и устал!", {'intelligence': 10, 'happiness': 15, 'energy': -15}),
-        ("Твой питомец участвовал в местном конкурсе талантов и проиграл.\nЕму стало грустно, так еще и он устал!", {'happiness': -20, 'energy': -15}),
-        ("Твой питомец обнаружил секретный проход в доме.\nЕму стало счастливее!", {'happiness': 25, 'intelligence': 5})
-    ]
-    return random.choice(events)
+async def periodic_update(notifier: Notifier, shard_index: int = 0, shard_count: int = 1):
+    # при шардировании каждый воркер проходит все слоты, но берет только своих
+    # питомцев (user_id % shard_count, как Supervisor.route): тик пишет мимо кэша,
+    # и кэш другого воркера затер бы его запись своими статами
+    async def process_own_pets(tick_slot: int):
+        await process_tick_slot(notifier, tick_slot, shard_index=shard_index, shard_count=shard_count)
+    wheel = TimeWheel(const.TICK_SLOTS, const.TICK_PERIOD, process_own_pets)
+    await wheel.run()
 
-async def main() -> None:
-    bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    storage = MemoryStorage()
+def create_bot() -> Bot:
+    session = AiohttpSession(api=TelegramAPIServer.from_base(API_URL)) if API_URL else None
+    bot = Bot(token=TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    bot.session.middleware(ApiTimer())
+    return bot
+
+async def start_services(bot: Bot, shard_index: int = 0, shard_count: int = 1):
+    if SQL_TRACE:
+        tracing.enable(SLOW_QUERY_MS)
+    init_db(DATABASE_PATH)
+
+    storage = SQLiteStorage()
+    storage.start()
     dp = Dispatcher(storage=storage)
     dp.include_router(router)
     
+    # метрики первыми, чтобы в задержку попал и ответ на callback
+    dp.message.middleware(MetricsMiddleware())
+    dp.callback_query.middleware(MetricsMiddleware())
     dp.callback_query.middleware(CallbackAnswerMiddleware())
-    
-    init_db() 
 
-    asyncio.create_task(periodic_update(bot))
+    pet_cache.start()
+    notifier = Notifier(bot)
+    notifier.start()
+    await timer_service.start(notifier, shard_index, shard_count)
+    pet_cache.add_listener(leaderboard.observe)
+    leaderboard.start()
+    metrics.add_gauges('notifier', notifier.stats)
+    metrics.add_gauges('pet_cache', pet_cache.stats)
+    metrics.add_gauges('timers', timer_service.stats)
+    metrics.add_gauges('leaderboard', leaderboard.stats)
+    await metrics.start(METRICS_HOST, METRICS_PORT + shard_index if METRICS_PORT else None, METRICS_SUMMARY_INTERVAL)
+    asyncio.create_task(periodic_update(notifier, shard_index, shard_count))
+    return dp, storage, notifier
+
+async def stop_services(bot: Bot, storage: SQLiteStorage, notifier: Notifier):
+    await metrics.close()
+    await timer_service.close()
+    await leaderboard.close()
+    await notifier.close()
+    await pet_cache.close()
+    await storage.close()
+    await bot.session.close()
+    shutdown_db_executors()
+    close_db()
+
+async def run_polling(dp: Dispatcher, bot: Bot):
+    # getUpdates не работает, пока у бота зарегистрирован вебхук
+    await bot.delete_webhook()
+    await dp.start_polling(bot)
+
+async def run_webhook(bot: Bot, feed, allowed_updates):
+    server = WebhookServer(feed,
+                           path=WEBHOOK_PATH,
+                           secret_token=WEBHOOK_SECRET,
+                           max_in_flight=WEBHOOK_MAX_IN_FLIGHT)
+    await server.start(WEBHOOK_HOST, WEBHOOK_PORT)
+    if WEBHOOK_URL:
+        await bot.set_webhook(f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+                              secret_token=WEBHOOK_SECRET,
+                              allowed_updates=allowed_updates,
+                              max_connections=min(100, WEBHOOK_MAX_IN_FLIGHT))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+## MARK: Sharding
+async def run_worker(shard_index: int, shard_count: int, queue):
+    bot = create_bot()
+    dp, storage, notifier = await start_services(bot, shard_index, shard_count)
+    processor = UpdateProcessor(lambda update: dp.feed_raw_update(bot, update))
+    try:
+        async for update in iter_updates(queue):
+            await processor.submit(update)
+        await processor.close()
+    finally:
+        await stop_services(bot, storage, notifier)
+
+def worker_process(shard_index: int, shard_count: int, queue):
+    setup_logging(f'pp_worker{shard_index}_{datetime.now().strftime("%d-%m-%Y_%H-%M-%S")}.log')
+    try:
+        asyncio.run(run_worker(shard_index, shard_count, queue))
+    except KeyboardInterrupt:
+        pass
 
+async def run_supervisor():
+    # схему базы готовим один раз, до старта воркеров
+    init_db(DATABASE_PATH)
+    close_db()
+    supervisor = Supervisor(worker_process, WORKERS)
+    supervisor.start()
+    bot = create_bot()
+    allowed_updates = router.resolve_used_update_types()
     try:
-        await dp.start_polling(bot)
+        if BOT_MODE == 'webhook':
+            await run_webhook(bot, supervisor.feed, allowed_updates)
+        else:
+            await bot.delete_webhook()
+            await supervisor.poll(bot, allowed_updates)
     finally:
+        await supervisor.close()
         await bot.session.close()
+## MARK END: Sharding
 
-if not os.path.exists(LOGGING_PATH):
-    os.makedirs(LOGGING_PATH)
-log_filename = f'pp_{datetime.now().strftime("%d-%m-%Y_%H-%M-%S")}.log'
+async def main() -> None:
+    if WORKERS > 1:
+        await run_supervisor()
+        return
 
-if __name__ == "__main__":
+    bot = create_bot()
+    dp, storage, notifier = await start_services(bot)
+    try:
+        if BOT_MODE == 'webhook':
+            await run_webhook(bot, lambda update: dp.feed_raw_update(bot, update), dp.resolve_used_update_types())
+        else:
+            await run_polling(dp, bot)
+    finally:
+        await stop_services(bot, storage, notifier)
+
+def setup_logging(filename: str):
     logging.basicConfig(
         level=logging.DEBUG,
-        format='[%(asctime)s]:%(levelname)s:%(funcName)s:%(message)s',
+        format='[%(asctime)s]:%(levelname)s:%(processName)s:%(funcName)s:%(message)s',
         datefmt='%Y-%m-%d|%H:%M:%S',
         handlers=[
-            logging.FileHandler(f"{LOGGING_PATH}/{log_filename}", mode='a', encoding='utf-8'),
+            logging.FileHandler(f"{LOGGING_PATH}/{filename}", mode='a', encoding='utf-8'),
             logging.StreamHandler(sys.stdout)
         ]
     )
-    asyncio.run(main())
\ No newline at end of file
+
+if not os.path.exists(LOGGING_PATH):
+    os.makedirs(LOGGING_PATH)
+log_filename = f'pp_{datetime.now().strftime("%d-%m-%Y_%H-%M-%S")}.log'
+
+if __name__ == "__main__":
+    setup_logging(log_filename)
+    asyncio.run(main())
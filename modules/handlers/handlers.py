@@ -1,12 +1,17 @@
 from aiogram import Router, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from modules.libraries.database import get_pet, create_pet, update_pet
+from modules.libraries.cache import get_pet, create_pet, apply_deltas
 from modules.libraries.constant import const
-from datetime import datetime, timedelta
-import asyncio
+from modules.libraries.personality import effect as personality_effect
+from modules.libraries.tricks import TRICK_NAMES, add_trick, missing_tricks
+from modules.libraries.leaderboard import leaderboard, category_value
+from modules.libraries.timers import timer_service, timer_action
+import html
+import time
 import random, math
 
 router = Router()
@@ -19,13 +24,9 @@ class PetStates(StatesGroup):
     waiting_for_math_answer = State()
     waiting_for_word_guess = State()
 
-def parse_datetime(date_string):
-    if not date_string:
-        return datetime.min
-    try:
-        return datetime.fromisoformat(date_string)
-    except (TypeError, ValueError):
-        return datetime.min
+def cooldown_passed(pet, column, cooldown):
+    # last_* хранятся в unix time, NULL - действия еще не было
+    return time.time() - (pet.get(column) or 0) > cooldown
 
 def get_main_keyboard():
     return ReplyKeyboardMarkup(
@@ -37,98 +38,109 @@ def get_main_keyboard():
             resize_keyboard=True
         )
 
-def check_evolution(pet: dict) -> str:
-    if all(pet[stat] >= 80 for stat in const.STATS):
-        new_form = random.choice(["Супер", "Мега", "Ультра", "Гипер"]) + pet['name']
-        update_pet(pet['user_id'], name=new_form)
-        return f"🎉 Поздравляем! Твой питомец эволюционировал в {new_form}!"
-    return ""
+TOP_TITLES = {
+    'intelligence': '🧠 Интеллект',
+    'happiness': '😊 Счастье',
+    'tricks': '🎓 Трюки',
+    'evolutions': '🌟 Эволюции',
+}
+
+def get_top_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=title, callback_data=f"top_{category}") for category, title in list(TOP_TITLES.items())[:2]],
+        [InlineKeyboardButton(text=title, callback_data=f"top_{category}") for category, title in list(TOP_TITLES.items())[2:]]
+    ])
 
 def apply_personality_effect(pet, stat, value):
-    personality = pet['personality']
-    if personality == 'Игривый':
-        if stat in ['happiness', 'energy']:
-            value *= 1.2
-        elif stat == 'intelligence':
-            value *= 0.9
-    elif personality == 'Ленивый':
-        if stat == 'energy':
-            value *= 0.8
-        elif stat in ['cleanliness', 'intelligence']:
-            value *= 1.1
-    elif personality == 'Любопытный':
-        if stat == 'intelligence':
-            value *= 1.2
-        elif stat == 'cleanliness':
-            value *= 0.9
-    elif personality == 'Дружелюбный':
-        if stat == 'happiness':
-            value *= 1.2
-        elif stat == 'intelligence':
-            value *= 0.9
-    elif personality == 'Застенчивый':
-        if stat == 'happiness':
-            value *= 0.9
-        elif stat == 'intelligence':
-            value *= 1.1
-    return round(value)
+    return personality_effect(pet['personality'], stat, value)
 ## MARK END: Utils
 
 ## MARK: Command handlers
 @router.message(Command("start"))
 async def cmd_start(message: Message, state: FSMContext):
-    pet = get_pet(message.from_user.id)
+    pet = await get_pet(message.from_user.id)
     if pet:
         await message.answer(f"✔ С возвращением! Твой питомец {pet['name']} ждет тебя!", reply_markup=get_main_keyboard())
     else:
         await message.answer("✔ Привет! Давай создадим твоего виртуального питомца. Как ты хочешь его назвать?")
         await state.set_state(PetStates.waiting_for_name)
 
+@router.message(Command("top"))
+async def cmd_top(message: Message):
+    await message.answer(await render_top(message.from_user.id, 'intelligence'), reply_markup=get_top_keyboard())
+
+@router.callback_query(F.data.startswith("top_"))
+async def process_top(callback_query: CallbackQuery):
+    category = callback_query.data[len("top_"):]
+    if category not in TOP_TITLES:
+        return
+    text = await render_top(callback_query.from_user.id, category)
+    try:
+        await callback_query.message.edit_text(text, reply_markup=get_top_keyboard())
+    except TelegramBadRequest as e:
+        # та же категория и те же места: Telegram не дает "изменить" текст на такой же
+        if "message is not modified" not in e.message:
+            raise
+
+async def render_top(user_id: int, category: str):
+    top_text = f"🏆 Лучшие питомцы - {TOP_TITLES[category]}:\n\n"
+    pets = await leaderboard.top(category)
+    for place, top_pet in enumerate(pets, 1):
+        top_text += f"{place}. {html.escape(top_pet.name)}: {category_value(category, top_pet)}\n"
+    if not pets:
+        top_text += "Пока здесь никого нет.\n"
+    pet = await get_pet(user_id)
+    if pet:
+        # место по свежей записи из кэша, с учетом последних действий
+        rank = leaderboard.rank(category, pet)
+        if rank is not None:
+            top_text += f"\n📍 {html.escape(pet['name'])} на {rank[0]} месте из {rank[1]}"
+    return top_text
+
 @router.message(PetStates.waiting_for_name)
 async def create_new_pet(message: Message, state: FSMContext):
-    create_pet(message.from_user.id, message.text)
-    pet = get_pet(message.from_user.id)
+    await create_pet(message.from_user.id, message.text)
+    pet = await get_pet(message.from_user.id)
     await cmd_status(message, f"✔ Отлично! Твой новый питомец {pet['name']} создан.\nУхаживай за ним хорошо! Вот его начальные характеристики:")
     await state.clear()
 
 @router.message(F.text == "🔍 Статус")
 async def cmd_status(message: Message, custom_message: str = None):
-    pet = get_pet(message.from_user.id)
+    pet = await get_pet(message.from_user.id)
     if pet:
-        if custom_message is not None: 
-            status_text = f"{custom_message}\n\n"
-        else:
-            status_text = f"Статус {pet['name']}:\n\n"
-        status_emoji = {
-            'hunger': '🍔 Голод',
-            'cleanliness': '🚿 Чистота',
-            'happiness': '😊 Счастье',
-            'energy': '⚡ Энергия',
-            'intelligence': '🧠 Интеллект',
-        }
-        for stat, emoji in status_emoji.items():
-            value = pet[stat]
-            bars = '█' * (value // 10) + '▒' * ((100 - value) // 10)
-            status_text += f"{emoji}: {bars} {value}/100\n"
-        
-        status_text += f"\n🙃 Характер: {pet['personality']}\n"
-        status_text += f"🥘 Любимая еда: {pet['favorite_food']}\n"
-        status_text += f"🏅 Любимое занятие: {pet['favorite_activity']}\n"
-        
-        evolution_message = check_evolution(pet)
-        if evolution_message:
-            status_text += f"\n{evolution_message}"
-        
-        await message.answer(status_text)
+        await message.answer(render_status(pet, custom_message))
     else:
         await message.answer("❌ У тебя еще нет питомца. Используй /start чтобы создать его.")
 
+def render_status(pet, custom_message: str = None):
+    if custom_message is not None: 
+        status_text = f"{custom_message}\n\n"
+    else:
+        status_text = f"Статус {pet['name']}:\n\n"
+    status_emoji = {
+        'hunger': '🍔 Голод',
+        'cleanliness': '🚿 Чистота',
+        'happiness': '😊 Счастье',
+        'energy': '⚡ Энергия',
+        'intelligence': '🧠 Интеллект',
+    }
+    for stat, emoji in status_emoji.items():
+        value = pet[stat]
+        bars = '█' * (value // 10) + '▒' * ((100 - value) // 10)
+        status_text += f"{emoji}: {bars} {value}/100\n"
+    
+    status_text += f"\n🙃 Характер: {pet['personality']}\n"
+    status_text += f"🥘 Любимая еда: {pet['favorite_food']}\n"
+    status_text += f"🏅 Любимое занятие: {pet['favorite_activity']}\n"
+    if pet.get('evolutions'):
+        status_text += f"🌟 Эволюций: {pet['evolutions']}\n"
+    return status_text
+
 @router.message(F.text == "🍽 Покормить")
 async def cmd_feed(message: Message):
-    pet = get_pet(message.from_user.id)
+    pet = await get_pet(message.from_user.id)
     if pet:
-        last_fed = parse_datetime(pet.get('last_fed'))
-        if datetime.now() - last_fed > timedelta(minutes=15):
+        if cooldown_passed(pet, 'last_fed', const.FEED_COOLDOWN):
             foods = ["🍎 Яблоко", "🥕 Морковь", "🍌 Банан", "🥜 Орехи", "🍓 Ягоды"]
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text=food, callback_data=f"feed_{food.split()[1]}") for food in foods[:3]],
@@ -143,7 +155,7 @@ async def cmd_feed(message: Message):
 @router.callback_query(F.data.startswith("feed_"))
 async def process_feed(callback_query: CallbackQuery):
     food = callback_query.data.split("_")[1]
-    pet = get_pet(callback_query.from_user.id)
+    pet = await get_pet(callback_query.from_user.id)
     
     hunger_reduction = apply_personality_effect(pet, 'hunger', random.randint(20, 40))
     energy_boost = apply_personality_effect(pet, 'energy', random.randint(10, 30))
@@ -153,15 +165,10 @@ async def process_feed(callback_query: CallbackQuery):
         hunger_reduction = int(hunger_reduction * 1.5)
         happiness_boost = int(happiness_boost * 2)
     
-    new_hunger = max(const.MIN_STAT, pet['hunger'] - hunger_reduction)
-    new_energy = min(const.MAX_STAT, pet['energy'] + energy_boost)
-    new_happiness = min(const.MAX_STAT, pet['happiness'] + happiness_boost)
-    
-    update_pet(callback_query.from_user.id, 
-               hunger=new_hunger, 
-               energy=new_energy, 
-               happiness=new_happiness, 
-               last_fed=datetime.now().isoformat())
+    pet = await apply_deltas(callback_query.from_user.id,
+                             {'hunger': -hunger_reduction, 'energy': energy_boost, 'happiness': happiness_boost},
+                             last_fed=int(time.time()))
+    new_hunger, new_energy, new_happiness = pet['hunger'], pet['energy'], pet['happiness']
     
     response = f"🍔 Ты покормил {pet['name']} {food}.\n"
     if food == pet['favorite_food']:
@@ -177,10 +184,9 @@ async def process_feed(callback_query: CallbackQuery):
 
 @router.message(F.text == "🚿 Помыть")
 async def cmd_clean(message: Message):
-    pet = get_pet(message.from_user.id)
+    pet = await get_pet(message.from_user.id)
     if pet:
-        last_cleaned = parse_datetime(pet.get('last_cleaned'))
-        if datetime.now() - last_cleaned > timedelta(minutes=25):
+        if cooldown_passed(pet, 'last_cleaned', const.CLEAN_COOLDOWN):
             cleaning_options = ["🧼 Мыло", "🧴 Шампунь", "🧽 Губка"]
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text=option, callback_data=f"clean_{option.split()[1]}") for option in cleaning_options]
@@ -194,7 +200,7 @@ async def cmd_clean(message: Message):
 @router.callback_query(F.data.startswith("clean_"))
 async def process_cleaning(callback_query: CallbackQuery):
     cleaning_item = callback_query.data.split("_")[1]
-    pet = get_pet(callback_query.from_user.id)
+    pet = await get_pet(callback_query.from_user.id)
     
     cleanliness_boost = apply_personality_effect(pet, 'cleanliness', random.randint(30, 50))
     happiness_change = apply_personality_effect(pet, 'happiness', random.randint(-10, 20))
@@ -207,13 +213,10 @@ async def process_cleaning(callback_query: CallbackQuery):
         cleanliness_boost += 5
         happiness_change += 5
     
-    new_cleanliness = min(const.MAX_STAT, pet['cleanliness'] + cleanliness_boost)
-    new_happiness = max(const.MIN_STAT, min(const.MAX_STAT, pet['happiness'] + happiness_change))
-    
-    update_pet(callback_query.from_user.id, 
-               cleanliness=new_cleanliness, 
-               happiness=new_happiness, 
-               last_cleaned=datetime.now().isoformat())
+    pet = await apply_deltas(callback_query.from_user.id,
+                             {'cleanliness': cleanliness_boost, 'happiness': happiness_change},
+                             last_cleaned=int(time.time()))
+    new_cleanliness, new_happiness = pet['cleanliness'], pet['happiness']
     
     response = f"✨ Ты помыл {pet['name']} с помощью {cleaning_item}.\n"
     response += f"Уровень чистоты теперь {new_cleanliness}/100, а счастья {new_happiness}/100.\n"
@@ -227,94 +230,78 @@ async def process_cleaning(callback_query: CallbackQuery):
 
 @router.message(F.text == "😴 Уложить спать")
 async def pet_sleep(message: Message):
-    pet = get_pet(message.from_user.id)
+    pet = await get_pet(message.from_user.id)
     if pet:
-        last_slept = parse_datetime(pet.get('last_slept'))
-        if datetime.now() - last_slept > timedelta(minutes=25) or pet.get('energy') < 40:
+        if cooldown_passed(pet, 'last_slept', const.SLEEP_COOLDOWN) or pet.get('energy') < 40:
             sleep_duration = random.randint(2, 7)
-            new_energy = min(100, pet['energy'] + sleep_duration * 10)
-            new_hunger = min(100, pet['hunger'] + sleep_duration * 5)
-            new_happiness = max(0, pet['happiness'] - sleep_duration * 2)
-            new_cleanliness = max(0, pet['cleanliness'] - sleep_duration * 3)
-            time_asleep = datetime.now() - timedelta(hours=sleep_duration)
-            time_asleep_str = time_asleep.isoformat()
+            now = int(time.time())
+            time_asleep = now - sleep_duration * 3600
             
-            update_pet(message.from_user.id, 
-                       energy=new_energy, 
-                       hunger=new_hunger, 
-                       happiness=new_happiness, 
-                       cleanliness=new_cleanliness, 
-                       last_slept=datetime.now().isoformat(),
-                       last_fed=time_asleep_str,
-                       last_cleaned=time_asleep_str,
-                       last_played=time_asleep_str)
+            await apply_deltas(message.from_user.id,
+                               {'energy': sleep_duration * 10,
+                                'hunger': sleep_duration * 5,
+                                'happiness': -sleep_duration * 2,
+                                'cleanliness': -sleep_duration * 3},
+                               last_slept=now,
+                               last_fed=time_asleep,
+                               last_cleaned=time_asleep,
+                               last_played=time_asleep)
             
             await message.answer(f"😴 {pet['name']} спит, дождись его пробуждения чтобы продолжить ухаживать за ним!")
-            await asyncio.sleep(sleep_duration)
-            await cmd_status(message, f"✔ {pet['name']} поспал {sleep_duration} часов и хорошо отдохнул!\nВот его нынешние характеристики:")
+            # пробуждение - таймер, а не asyncio.sleep в хендлере: переживает перезапуск
+            await timer_service.add(sleep_duration, 'wake_up', message.from_user.id, {'hours': sleep_duration})
         else:
             await message.answer(f"❌ {pet['name']} еще не устал. Подожди немного перед следующим сном.")
     else:
         await message.answer("❌ У тебя еще нет питомца. Используй /start чтобы создать его.")
 
 
+@timer_action('wake_up')
+async def wake_up(user_id: int, payload: dict, notifier):
+    pet = await get_pet(user_id)
+    if pet:
+        notifier.enqueue(user_id, render_status(pet, f"✔ {pet['name']} поспал {payload['hours']} часов и хорошо отдохнул!\nВот его нынешние характеристики:"))
+
 @router.message(F.text == "📚 Учить трюк")
 async def cmd_learn_trick(message: Message):
-    pet = get_pet(message.from_user.id)
+    pet = await get_pet(message.from_user.id)
     if pet:
-        result = learn_new_trick(pet)
+        result = await learn_new_trick(pet)
         await message.answer(result)
     else:
         await message.answer("❌ У тебя еще нет питомца. Используй /start чтобы создать его.")
 
-def learn_new_trick(pet):
-    tricks = {
-        "sit": "сидеть",
-        "roll over": "перевернуться", 
-        "fetch": "принести",
-        "speak": "голос",
-        "play dead": "притвориться мёртвым"
-    }
-    
-    if pet['tricks'] is None:
-        pet['tricks'] = []
-    
-    available_tricks = [t for t in tricks if tricks[t] not in pet['tricks']] 
+async def learn_new_trick(pet):
+    available_tricks = missing_tricks(pet['tricks'])
     if not available_tricks:
         return f"🎓 {pet['name']} уже знает все доступные команды!"
     
     new_trick_key = random.choice(available_tricks)
-    new_trick = tricks[new_trick_key]
+    new_trick = TRICK_NAMES[new_trick_key]
     
     success_chance = (1 - math.sqrt(random.random()))
     intelligence_factor = pet['intelligence'] / 100
     
     if success_chance < intelligence_factor:
-        pet['tricks'].append(new_trick)
-        
         intelligence_boost = apply_personality_effect(pet, 'intelligence', random.randint(5, 15))
         happiness_boost = apply_personality_effect(pet, 'happiness', random.randint(10, 20))
         
-        new_intelligence = min(const.MAX_STAT, pet['intelligence'] + intelligence_boost)
-        new_happiness = min(const.MAX_STAT, pet['happiness'] + happiness_boost)
-        
-        update_pet(pet['user_id'],
-                   tricks=pet['tricks'],
-                   intelligence=new_intelligence,
-                   happiness=new_happiness)
+        updated = await apply_deltas(pet['user_id'],
+                                     {'intelligence': intelligence_boost, 'happiness': happiness_boost},
+                                     tricks=add_trick(pet['tricks'], new_trick_key))
+        new_intelligence, new_happiness = updated['intelligence'], updated['happiness']
         
         return f'🎉 {pet["name"]} успешно выучил новую команду: {new_trick}! Уровень интеллекта теперь {new_intelligence}/100, а счастья {new_happiness}/100.'
     else:
         energy_reduction = apply_personality_effect(pet, 'energy', random.randint(5, 10))
-        new_energy = max(const.MIN_STAT, pet['energy'] - energy_reduction)
-        
-        update_pet(pet['user_id'], energy=new_energy)
+        updated = await apply_deltas(pet['user_id'], {'energy': -energy_reduction})
+        new_energy = updated['energy']
         
         return f'😓 {pet["name"]} старался, но пока не смог выучить команду {new_trick}, ведь его интеллект {intelligence_factor:.2f} ниже ожидаемого {success_chance:.2f}. Уровень энергии теперь {new_energy}/100. Попробуй в следующий раз!'
 
 @router.message(F.text == "🎮 Поиграть")
 async def cmd_play(message: Message, state: FSMContext):
-    pet = get_pet(message.from_user.id)
+    pet = await get_pet(message.from_user.id)
     if pet and can_play(pet):
         games = ["🧩 Загадки", "🔢 Математика", "🔤 Угадай слово"]
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -329,7 +316,7 @@ async def cmd_play(message: Message, state: FSMContext):
 @router.callback_query(PetStates.waiting_for_game_choice)
 async def process_game_choice(callback_query: CallbackQuery, state: FSMContext):
     game = callback_query.data.split("_")[1]
-    pet = get_pet(callback_query.from_user.id)
+    pet = await get_pet(callback_query.from_user.id)
     
     if game == "Загадки":
         await start_riddle_game(callback_query, state)
@@ -379,7 +366,7 @@ async def process_riddle_answer(message: Message, state: FSMContext):
     data = await state.get_data()
     correct_answer = data.get("correct_answer")
     user_answer = str(message.text.lower())
-    pet = get_pet(message.from_user.id)
+    pet = await get_pet(message.from_user.id)
     
     if user_answer == correct_answer:
         await process_correct_answer(message, state, "Загадки")
@@ -421,11 +408,10 @@ async def process_word_guess(message: Message, state: FSMContext):
 
 ## MARK: Some more utils
 def can_play(pet):
-    last_played = parse_datetime(pet.get('last_played'))
-    return datetime.now() - last_played > timedelta(minutes=10)
+    return cooldown_passed(pet, 'last_played', const.PLAY_COOLDOWN)
 
 async def process_correct_answer(message: Message, state: FSMContext, game_type):
-    pet = get_pet(message.from_user.id)
+    pet = await get_pet(message.from_user.id)
     happiness_boost = apply_personality_effect(pet, 'happiness', random.randint(20, 40))
     intelligence_boost = apply_personality_effect(pet, 'intelligence', random.randint(15, 30))
     energy_reduction = apply_personality_effect(pet, 'energy', random.randint(10, 20))
@@ -434,15 +420,10 @@ async def process_correct_answer(message: Message, state: FSMContext, game_type)
         happiness_boost = int(happiness_boost * 1.5)
         intelligence_boost = int(intelligence_boost * 1.5)
     
-    new_happiness = min(const.MAX_STAT, pet['happiness'] + happiness_boost)
-    new_intelligence = min(const.MAX_STAT, pet['intelligence'] + intelligence_boost)
-    new_energy = max(const.MIN_STAT, pet['energy'] - energy_reduction)
-    
-    update_pet(message.from_user.id, 
-               happiness=new_happiness, 
-               intelligence=new_intelligence, 
-               energy=new_energy,
-               last_played=datetime.now().isoformat())
+    pet = await apply_deltas(message.from_user.id,
+                             {'happiness': happiness_boost, 'intelligence': intelligence_boost, 'energy': -energy_reduction},
+                             last_played=int(time.time()))
+    new_happiness, new_intelligence, new_energy = pet['happiness'], pet['intelligence'], pet['energy']
     
     response = f"✨ Отлично! {pet['name']} в восторге от вашей совместной игры в {game_type}. "
     if game_type == pet['favorite_activity']:
@@ -458,10 +439,10 @@ async def process_correct_answer(message: Message, state: FSMContext, game_type)
     await state.clear()
 
 async def process_wrong_answer(message: Message, state: FSMContext, correct_answer):
-    pet = get_pet(message.from_user.id)
-    new_happiness = min(100, pet['happiness'] + 10)
-    new_intelligence = min(100, pet['intelligence'] - random.randint(2, 15))
-    update_pet(message.from_user.id, happiness=new_happiness, intelligence=new_intelligence, last_played=datetime.now().isoformat())
+    pet = await apply_deltas(message.from_user.id,
+                             {'happiness': 10, 'intelligence': -random.randint(2, 15)},
+                             last_played=int(time.time()))
+    new_happiness, new_intelligence = pet['happiness'], pet['intelligence']
     await message.answer(f"❌ К сожалению, это неправильный ответ. {correct_answer}.\n{pet['name']} все равно доволен, что вы играли вместе. Уровень счастья теперь {new_happiness}/100, а интеллекта {new_intelligence}/100.")
     await state.clear()
 
@@ -0,0 +1,79 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from modules.libraries import database
+from modules.libraries.database import READER_POOL_SIZE
+
+# Асинхронная обертка над database.py для хендлеров. sqlite3 блокирует поток на
+# время запроса и fsync, поэтому запросы выполняются вне event loop: все записи
+# идут через один поток (очередь executor'а сериализует их без борьбы за лок
+# писателя), чтения - через пул потоков по числу соединений-читателей.
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+_readers = ThreadPoolExecutor(max_workers=READER_POOL_SIZE, thread_name_prefix='db-reader')
+
+# [время в базе, время в Bot API] текущего апдейта, заводит metrics.MetricsMiddleware
+current_timings = ContextVar('current_timings', default=None)
+
+async def _run(executor, fn, args, kwargs):
+    loop = asyncio.get_running_loop()
+    call = functools.partial(fn, *args, **kwargs)
+    timings = current_timings.get()
+    if timings is None:
+        return await loop.run_in_executor(executor, call)
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(executor, call)
+    finally:
+        timings[0] += time.perf_counter() - started
+
+async def run_read(fn, *args, **kwargs):
+    return await _run(_readers, fn, args, kwargs)
+
+async def run_write(fn, *args, **kwargs):
+    return await _run(_writer, fn, args, kwargs)
+
+async def get_pet(user_id: int):
+    return await run_read(database.get_pet, user_id)
+
+async def create_pet(user_id: int, name: str):
+    return await run_write(database.create_pet, user_id, name)
+
+async def apply_deltas(user_id: int, deltas: dict, clamp: bool = True, previous: list = None, **fields):
+    return await run_write(database.apply_deltas, user_id, deltas, clamp, previous, **fields)
+
+async def update_pets(updates):
+    return await run_write(database.update_pets, updates)
+
+async def get_active_user_ids(tick_slot: int, shard_index: int = 0, shard_count: int = 1):
+    return await run_read(database.get_active_user_ids, tick_slot,
+                          shard_index=shard_index, shard_count=shard_count)
+
+async def get_neglected_user_ids(tick_slot: int, idle_for: int, shard_index: int = 0, shard_count: int = 1):
+    return await run_read(database.get_neglected_user_ids, tick_slot, idle_for,
+                          shard_index=shard_index, shard_count=shard_count)
+
+async def get_evolution_candidates(tick_slot: int, shard_index: int = 0, shard_count: int = 1):
+    return await run_read(database.get_evolution_candidates, tick_slot,
+                          shard_index=shard_index, shard_count=shard_count)
+
+async def evolve_pets(forms: dict):
+    return await run_write(database.evolve_pets, forms)
+
+async def get_top_pets(category: str, limit: int):
+    return await run_read(database.get_top_pets, category, limit)
+
+async def add_timer(due: float, action: str, user_id: int, payload: str = None):
+    return await run_write(database.add_timer, due, action, user_id, payload)
+
+async def delete_timers(timer_ids):
+    return await run_write(database.delete_timers, timer_ids)
+
+async def load_timers(shard_index: int = 0, shard_count: int = 1):
+    return await run_read(database.load_timers, shard_index, shard_count)
+
+def shutdown():
+    # дожидаемся уже поставленных записей, потом можно закрывать пул соединений
+    _writer.shutdown(wait=True)
+    _readers.shutdown(wait=True)
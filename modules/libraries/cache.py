@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from modules.libraries import async_database
+from modules.libraries.database import materialize_decay
+from modules.libraries.constant import const
+
+CACHE_SIZE = 10000
+FLUSH_INTERVAL = 5  # секунд, сколько изменения могут жить только в памяти
+
+class PetCache():
+    # Write-behind кэш питомцев по user_id. За одну игровую сессию одна и та же
+    # запись читается и пишется несколько раз: чтения отдаются из памяти, а все
+    # apply_deltas между сбросами склеиваются в одну запись на питомца. Кэш главный
+    # для своих записей: при сбросе пишутся измененные колонки вместе со статами и
+    # last_tick, поэтому затухание в памяти и в базе не расходится.
+    def __init__(self, max_size: int = CACHE_SIZE, flush_interval: float = FLUSH_INTERVAL):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._pets = OrderedDict()
+        self._dirty = {}
+        self._flushing = set()  # пишутся прямо сейчас: не выселять, иначе перечитаем старую строку
+        self._loading = {}  # user_id -> asyncio.Event, пока идет обращение к базе мимо памяти
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        self._listeners = []  # listener(до, после) на каждое изменение; до - None у нового питомца
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0
+        self.writes = 0
+
+    def start(self):
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
+
+    async def get_pet(self, user_id: int):
+        pet, _ = await self._fetch(user_id, lambda: async_database.get_pet(user_id))
+        if pet is None:
+            return None
+        materialize_decay(pet)
+        # копия: хендлеры меняют словарь, но в кэш попадает только то, что прошло через apply_deltas
+        return dict(pet)
+
+    async def create_pet(self, user_id: int, name: str):
+        self._pets.pop(user_id, None)
+        self._dirty.pop(user_id, None)
+        await async_database.create_pet(user_id, name)
+        # новый питомец сразу попадает в кэш: хендлер прочитает его следующим шагом
+        pet = await self.get_pet(user_id)
+        if pet is not None:
+            self._changed(None, pet)
+
+    async def apply_deltas(self, user_id: int, deltas: dict, clamp: bool = True, **fields):
+        # питомца нет в памяти - одно атомарное обновление в базе с RETURNING,
+        # результат становится записью кэша
+        previous = []
+        pet, fetched = await self._fetch(user_id,
+                                         lambda: async_database.apply_deltas(user_id, deltas, clamp, previous, **fields))
+        if pet is None:
+            return None
+        old = previous[0] if previous else None
+        if not fetched:
+            # в памяти чтение и запись идут без await между ними, поэтому атомарны
+            self.updates += 1
+            materialize_decay(pet)
+            old = dict(pet)
+            for stat, delta in deltas.items():
+                value = pet[stat] + delta
+                pet[stat] = max(const.MIN_STAT, min(const.MAX_STAT, value)) if clamp else value
+            self._assign(user_id, pet, fields)
+            self._dirty[user_id].update(deltas)
+        self._changed(old, pet)
+        return dict(pet)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            now = int(time.time())
+            updates = []
+            pets = {}
+            for user_id, columns in dirty.items():
+                pet = self._pets.get(user_id)
+                if pet is None:
+                    continue
+                materialize_decay(pet, now)
+                columns.update(const.STATS)
+                columns.add('last_tick')
+                pets[user_id] = pet
+                updates.append((user_id, {column: pet[column] for column in columns}))
+            self._flushing.update(pets)
+            try:
+                await async_database.update_pets(updates)
+            except Exception:
+                # возвращаем колонки в грязные; значения в записи кэша и так самые
+                # новые, поэтому изменения, пришедшие во время записи, не теряются.
+                # Питомца, которого за это время пересоздали, не трогаем.
+                for user_id, pet in pets.items():
+                    if self._pets.get(user_id) is pet:
+                        self._dirty.setdefault(user_id, set()).update(dirty[user_id])
+                raise
+            finally:
+                self._flushing.difference_update(pets)
+            self.writes += len(updates)
+            self._evict()
+
+    @asynccontextmanager
+    async def bypass(self, user_ids):
+        # Для записей в обход кэша (тик): сбрасываем изменения этих питомцев,
+        # забываем их и не даем загрузить заново, пока запись не закончится.
+        user_ids = set(user_ids)
+        while True:
+            pending = [self._loading[user_id] for user_id in user_ids if user_id in self._loading]
+            if not pending:
+                break
+            await asyncio.gather(*(event.wait() for event in pending))
+        released = asyncio.Event()
+        for user_id in user_ids:
+            self._loading[user_id] = released
+        try:
+            while any(user_id in self._dirty for user_id in user_ids):
+                await self.flush()
+            for user_id in user_ids:
+                self._pets.pop(user_id, None)
+            yield
+        finally:
+            for user_id in user_ids:
+                del self._loading[user_id]
+            released.set()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._pets),
+            'dirty': len(self._dirty),
+            'hits': self.hits,
+            'misses': self.misses,
+            'updates': self.updates,
+            'writes': self.writes,
+        }
+
+    async def _fetch(self, user_id: int, load):
+        # Возвращает (запись кэша, была ли она только что получена из базы).
+        # Одновременные промахи по одному питомцу ждут первое обращение к базе.
+        while user_id in self._loading:
+            await self._loading[user_id].wait()
+        pet = self._pets.get(user_id)
+        if pet is not None:
+            self.hits += 1
+            self._pets.move_to_end(user_id)
+            return pet, False
+        self.misses += 1
+        loaded = self._loading[user_id] = asyncio.Event()
+        try:
+            pet = await load()
+        finally:
+            del self._loading[user_id]
+            loaded.set()
+        if pet is not None:
+            # выселяем до вставки: только что загруженного питомца сейчас изменят,
+            # а грязным он станет лишь после этого
+            self._evict(reserve=1)
+            self._pets[user_id] = pet
+        return pet, True
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _changed(self, old, pet: dict):
+        for listener in self._listeners:
+            listener(old, pet)
+
+    def _assign(self, user_id: int, pet: dict, fields: dict):
+        pet.update(fields)
+        self._dirty.setdefault(user_id, set()).update(fields)
+
+    def _evict(self, reserve: int = 0):
+        # выселяем самых старых чистых питомцев; грязные дождутся сброса
+        limit = self.max_size - reserve
+        if len(self._pets) <= limit:
+            return
+        for user_id in list(self._pets):
+            if len(self._pets) <= limit:
+                break
+            if user_id not in self._dirty and user_id not in self._flushing:
+                del self._pets[user_id]
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("PetCache >> flush failed")
+
+pet_cache = PetCache()
+
+async def get_pet(user_id: int):
+    return await pet_cache.get_pet(user_id)
+
+async def create_pet(user_id: int, name: str):
+    return await pet_cache.create_pet(user_id, name)
+
+async def apply_deltas(user_id: int, deltas: dict, clamp: bool = True, **fields):
+    return await pet_cache.apply_deltas(user_id, deltas, clamp, **fields)
@@ -4,4 +4,16 @@ class const():
     STAT_DECAY_RATE = 5
     STAT_BOOST_RATE = 10
     STATS = ['hunger', 'cleanliness', 'happiness', 'energy']
-    NEWSTATS = ['hunger', 'cleanliness', 'happiness', 'energy', 'intelligence']
\ No newline at end of file
+    NEWSTATS = ['hunger', 'cleanliness', 'happiness', 'energy', 'intelligence']
+    RISING_STATS = ['hunger', 'energy']  # со временем растут, остальные из STATS убывают
+    EVENT_CHANCE = 0.3
+    TICK_PERIOD = 3600  # секунд на один шаг затухания
+    ACTIVE_WINDOW = 24 * 3600  # питомцы без ухода дольше этого не получают случайных событий
+    FEED_COOLDOWN = 15 * 60  # секунд между кормлениями
+    CLEAN_COOLDOWN = 25 * 60
+    SLEEP_COOLDOWN = 25 * 60
+    PLAY_COOLDOWN = 10 * 60
+    EVOLUTION_THRESHOLD = 80  # все статы из STATS не ниже этого - питомец эволюционирует на тике
+    EVOLUTION_STEP = 5  # на сколько растет порог с каждой следующей стадией
+    MAX_EVOLUTION_STAGE = 4  # после этой стадии питомец больше не эволюционирует
+    TICK_SLOTS = 720  # тик размазан по часу: каждые TICK_PERIOD / TICK_SLOTS секунд обрабатывается один слот
@@ -1,91 +1,389 @@
+import logging
 import sqlite3
-from datetime import datetime
-import random, json
+import threading
+import queue
+import time
+from contextlib import contextmanager
+import random
 from modules.libraries.constant import const
+from modules.libraries.personality import random_personality
+from modules.libraries import migrations, tracing
+from modules.libraries.migrations import ACTIVITY_EXPR, EVOLUTION_FILTER, HAPPINESS_EXPR, TRICKS_COUNT_EXPR
 DATABASE_NAME = 'PetPet.db'
+READER_POOL_SIZE = 4
+PET_CHUNK = 1000  # строк на один запрос в iter_pets
+STATEMENT_CACHE_SIZE = 256
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',     # в WAL режиме NORMAL безопасен и не делает fsync на каждый коммит
+    'PRAGMA cache_size = -16000',      # 16 MB page cache на соединение
+    'PRAGMA mmap_size = 268435456',    # 256 MB
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA busy_timeout = 5000',
+)
 
-def init_db():
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS pets (
-            user_id INTEGER PRIMARY KEY,
-            name TEXT,
-            hunger INTEGER DEFAULT 50,
-            cleanliness INTEGER DEFAULT 50,
-            happiness INTEGER DEFAULT 50,
-            energy INTEGER DEFAULT 100,
-            intelligence INTEGER DEFAULT 10,
-            last_fed TEXT,
-            last_cleaned TEXT,
-            last_played TEXT,
-            last_slept TEXT,
-            personality TEXT,
-            favorite_food TEXT,
-            favorite_activity TEXT,
-            tricks TEXT NULL
-        )
-    ''')
-    conn.commit()
-    conn.close()
+## MARK: Connection pool
+class ConnectionPool():
+    # Один долгоживущий писатель и небольшой пул читателей. В WAL режиме читатели
+    # не блокируют писателя и видят последний закоммиченный снимок.
+    def __init__(self, database_name: str, readers: int = READER_POOL_SIZE):
+        self.database_name = database_name
+        self._write_lock = threading.RLock()
+        self._writer = self._connect()
+        self._readers = queue.LifoQueue()
+        self._all_readers = []
+        for _ in range(readers):
+            conn = self._connect(readonly=True)
+            self._all_readers.append(conn)
+            self._readers.put(conn)
+
+    def _connect(self, readonly: bool = False):
+        conn = sqlite3.connect(self.database_name,
+                               check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE,
+                               factory=tracing.TracedConnection if tracing.enabled else sqlite3.Connection)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        if readonly:
+            conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    @contextmanager
+    def writer(self):
+        with self._write_lock:
+            try:
+                yield self._writer
+                self._writer.commit()
+            except BaseException:
+                self._writer.rollback()
+                raise
+
+    @contextmanager
+    def reader(self):
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    def close(self):
+        with self._write_lock:
+            self._writer.close()
+        for conn in self._all_readers:
+            conn.close()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DATABASE_NAME)
+    return _pool
+
+def close_db():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+## MARK END: Connection pool
+
+def init_db(database_name: str = None):
+    global DATABASE_NAME
+    if database_name is not None and database_name != DATABASE_NAME:
+        close_db()
+        DATABASE_NAME = database_name
+    migrations.migrate(get_pool())
+
+def tick_slot_for(user_id: int) -> int:
+    return user_id % const.TICK_SLOTS
 
 def dict_factory(cursor, row):
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+    return dict(zip([col[0] for col in cursor.description], row))
 
 def get_pet(user_id: int):
-    conn = sqlite3.connect(DATABASE_NAME)
-    conn.row_factory = dict_factory
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM pets WHERE user_id = ?', (user_id,))
-    pet = cursor.fetchone()
-    conn.close()
-    return pet
+    with get_pool().reader() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = dict_factory
+        cursor.execute('SELECT * FROM pets WHERE user_id = ?', (user_id,))
+        pet = cursor.fetchone()
+    return materialize_decay(pet) if pet else pet
 
 def create_pet(user_id: int, name: str):
-    personality = random.choice(['Игривый', 'Ленивый', 'Любопытный', 'Дружелюбный', 'Застенчивый'])
+    personality = random_personality()
     favorite_food = random.choice(['Яблоко', 'Морковь', 'Банан', 'Орехи', 'Ягоды'])
     favorite_activity = random.choice(['Математика', 'Загадки', 'Угадайки'])
-    
+
     initial_stats = {stat: random.randint(30, 60) for stat in const.NEWSTATS}
-    
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO pets (user_id, name, personality, favorite_food, favorite_activity,
-                          hunger, cleanliness, happiness, energy, intelligence)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (user_id, name, personality, favorite_food, favorite_activity,
-          initial_stats['hunger'], initial_stats['cleanliness'], initial_stats['happiness'],
-          initial_stats['energy'], initial_stats['intelligence']))
-    conn.commit()
-    conn.close()
-
-def update_pet(user_id: int, **kwargs):
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    for key, value in kwargs.items():
-        if isinstance(value, list):
-            kwargs[key] = json.dumps(value)
-    
-    set_clause = ', '.join(f'{k} = ?' for k in kwargs)
-    query = f'UPDATE pets SET {set_clause} WHERE user_id = ?'
-    
+
+    with get_pool().writer() as conn:
+        conn.execute('''
+            INSERT INTO pets (user_id, name, personality, favorite_food, favorite_activity,
+                              hunger, cleanliness, happiness, energy, intelligence, last_tick, tick_slot)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, name, personality, favorite_food, favorite_activity,
+              initial_stats['hunger'], initial_stats['cleanliness'], initial_stats['happiness'],
+              initial_stats['energy'], initial_stats['intelligence'], int(time.time()), tick_slot_for(user_id)))
+
+def _update_statement(user_id: int, kwargs: dict):
+    # Значения из kwargs посчитаны от уже затухших статов (см. get_pet), поэтому
+    # при записи сохраняем накопленное затухание остальных статов и сдвигаем
+    # last_tick на целое число тиков. Если last_tick передан явно, вызывающий
+    # код сам отвечает за затухание.
+    params = dict(kwargs, user_id=user_id)
+    # сортируем колонки, чтобы одинаковый набор полей давал один и тот же текст
+    # запроса и попадал в кэш подготовленных выражений
+    assignments = [f'{k} = :{k}' for k in sorted(kwargs)]
+    if 'last_tick' not in kwargs:
+        assignments += [f'{stat} = {_decay_expr(stat)}' for stat in const.STATS if stat not in kwargs]
+        assignments.append(f'last_tick = {ADVANCED_LAST_TICK}')
+        params.update(_decay_params())
+    return f'UPDATE pets SET {", ".join(assignments)} WHERE user_id = :user_id', params
+
+def update_pets(updates):
+    # updates: [(user_id, {column: value}), ...] - пишутся одной транзакцией
+    statements = [_update_statement(user_id, dict(fields)) for user_id, fields in updates if fields]
+    if not statements:
+        return
+    try:
+        with get_pool().writer() as conn:
+            for query, params in statements:
+                conn.execute(query, params)
+    except sqlite3.Error:
+        # вызывающий (сброс кэша) вернет изменения в очередь и повторит
+        logging.exception(f"update_pets >> failed to write {len(statements)} pets")
+        raise
+
+def apply_deltas(user_id: int, deltas: dict, clamp: bool = True, previous: list = None, **fields):
+    # Приращения статов считаются прямо в UPDATE (вместе с накопленным затуханием),
+    # без чтения-изменения-записи: два быстрых нажатия не теряют друг друга.
+    # fields - обычные присваивания (например, last_fed). Возвращает новую запись;
+    # в previous, если передан, добавляется запись до изменения (для лидерборда).
+    params = dict(_decay_params(), user_id=user_id)
+    assignments = []
+    for stat in const.NEWSTATS:
+        if stat in deltas:
+            params[f'd_{stat}'] = deltas[stat]
+            value = f'{_decay_expr(stat)} + :d_{stat}'
+            if clamp:
+                value = f'MAX(:min_stat, MIN(:max_stat, {value}))'
+            assignments.append(f'{stat} = {value}')
+        elif stat in const.STATS:
+            assignments.append(f'{stat} = {_decay_expr(stat)}')
+    for key in sorted(fields):
+        params[key] = fields[key]
+        assignments.append(f'{key} = :{key}')
+    assignments.append(f'last_tick = {ADVANCED_LAST_TICK}')
+    query = f'UPDATE pets SET {", ".join(assignments)} WHERE user_id = :user_id RETURNING *'
+
     try:
-        cursor.execute(query, tuple(kwargs.values()) + (user_id,))
-        conn.commit()
-    except sqlite3.Error as e:
-        print(f"An error occurred: {e}")
-    finally:
-        conn.close()
-
-def get_all_pets():
-    conn = sqlite3.connect(DATABASE_NAME)
-    conn.row_factory = dict_factory
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM pets')
-    pets = cursor.fetchall()
-    conn.close()
-    return pets
\ No newline at end of file
+        with get_pool().writer() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = dict_factory
+            if previous is not None:
+                # в той же транзакции писателя: между чтением и записью питомца никто не изменит
+                cursor.execute('SELECT * FROM pets WHERE user_id = ?', (user_id,))
+                row = cursor.fetchone()
+                if row is not None:
+                    previous.append(materialize_decay(row, params['now']))
+            cursor.execute(query, params)
+            return cursor.fetchone()
+    except sqlite3.Error:
+        logging.exception(f"apply_deltas >> failed for user {user_id}")
+
+## MARK: Iteration
+PET_COLUMNS = ('user_id', 'name', *const.NEWSTATS, 'last_fed', 'last_cleaned', 'last_played', 'last_slept',
+               'personality', 'favorite_food', 'favorite_activity', 'tricks', 'evolutions', 'last_tick', 'tick_slot')
+
+class Pet():
+    # Компактная запись для обхода всей таблицы: слоты вместо словаря на строку.
+    # Поддерживает и pet.name, и pet['name'] / pet.get('name'), как dict из get_pet.
+    __slots__ = PET_COLUMNS
+
+    def __init__(self, row):
+        for column, value in zip(PET_COLUMNS, row):
+            setattr(self, column, value)
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key: str, value):
+        setattr(self, key, value)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key, default)
+
+    def as_dict(self) -> dict:
+        return {column: getattr(self, column) for column in PET_COLUMNS}
+
+    def __repr__(self):
+        return f'Pet({self.user_id}, {self.name!r})'
+
+def iter_pets(chunk: int = PET_CHUNK, now: int = None):
+    # Постраничный обход по первичному ключу: каждый кусок - отдельный короткий
+    # запрос, соединение читателя не держится между кусками, а в памяти не больше
+    # chunk записей. Затухание досчитывается на один момент времени для всех.
+    now = int(time.time()) if now is None else now
+    query = f'SELECT {", ".join(PET_COLUMNS)} FROM pets WHERE user_id > ? ORDER BY user_id LIMIT ?'
+    last_id = -2 ** 63
+    while True:
+        with get_pool().reader() as conn:
+            rows = conn.execute(query, (last_id, chunk)).fetchall()
+        for row in rows:
+            yield materialize_decay(Pet(row), now)
+        if len(rows) < chunk:
+            return
+        last_id = rows[-1][0]
+## MARK END: Iteration
+
+## MARK: Evolution
+# EVOLUTION_FILTER (migrations) выбирает кандидатов по partial index
+# idx_pets_evolution_stage; точная проверка идет по статам с досчитанным
+# затуханием против порога следующей стадии.
+def _evolution_condition() -> str:
+    return ' AND '.join(f'{_decay_expr(stat)} >= :threshold + :step * evolutions' for stat in const.STATS)
+
+def _evolution_params(now: int = None) -> dict:
+    return dict(_decay_params(now), threshold=const.EVOLUTION_THRESHOLD, step=const.EVOLUTION_STEP)
+
+def get_evolution_candidates(tick_slot: int, now: int = None, shard_index: int = 0, shard_count: int = 1):
+    params = dict(_evolution_params(now), tick_slot=tick_slot, shard_index=shard_index, shard_count=shard_count)
+    with get_pool().reader() as conn:
+        return [row[0] for row in conn.execute(f'''
+            SELECT user_id FROM pets
+            WHERE tick_slot = :tick_slot AND {EVOLUTION_FILTER} AND {_evolution_condition()}
+              AND user_id % :shard_count = :shard_index
+        ''', params)]
+
+def evolve_pets(forms: dict, now: int = None):
+    # forms: {user_id: приставка к имени}. Условие проверяется еще раз при записи:
+    # между выборкой кандидатов и записью статы могли измениться. Возвращает
+    # [(user_id, новое имя, новая стадия)] тех, кто эволюционировал.
+    params = _evolution_params(now)
+    query = f'''
+        UPDATE pets SET name = :prefix || name, evolutions = evolutions + 1
+        WHERE user_id = :user_id AND {EVOLUTION_FILTER} AND {_evolution_condition()}
+        RETURNING user_id, name, evolutions
+    '''
+    evolved = []
+    with get_pool().writer() as conn:
+        for user_id, prefix in forms.items():
+            row = conn.execute(query, dict(params, user_id=user_id, prefix=prefix)).fetchone()
+            if row is not None:
+                evolved.append(row)
+    return evolved
+## MARK END: Evolution
+
+## MARK: Leaderboard
+# категория -> (выражение из индекса, условие partial index)
+LEADERBOARD_ORDER = {
+    'intelligence': ('intelligence', None),
+    'happiness': (HAPPINESS_EXPR, None),
+    'tricks': (TRICKS_COUNT_EXPR, 'tricks != 0'),
+    'evolutions': ('evolutions', 'evolutions > 0'),
+}
+
+def get_top_pets(category: str, limit: int):
+    # ORDER BY совпадает с индексом категории: читаются только первые limit строк
+    expression, condition = LEADERBOARD_ORDER[category]
+    where = f'WHERE {condition} ' if condition else ''
+    now = int(time.time())
+    with get_pool().reader() as conn:
+        rows = conn.execute(f'SELECT {", ".join(PET_COLUMNS)} FROM pets {where}'
+                            f'ORDER BY {expression} DESC, user_id LIMIT ?', (limit,)).fetchall()
+    return [materialize_decay(Pet(row), now) for row in rows]
+
+def count_leaderboard_values(category: str, now: int = None):
+    # [(значение, число питомцев)] для сборки лидерборда; счастье - текущее, с затуханием
+    expression = _decay_expr(category) if category in const.STATS else LEADERBOARD_ORDER[category][0]
+    with get_pool().reader() as conn:
+        return conn.execute(f'SELECT {expression}, COUNT(*) FROM pets GROUP BY 1', _decay_params(now)).fetchall()
+## MARK END: Leaderboard
+
+## MARK: Timers
+def add_timer(due: float, action: str, user_id: int, payload: str = None) -> int:
+    with get_pool().writer() as conn:
+        return conn.execute('INSERT INTO timers (due, action, user_id, payload) VALUES (?, ?, ?, ?)',
+                            (due, action, user_id, payload)).lastrowid
+
+def delete_timers(timer_ids):
+    if not timer_ids:
+        return
+    with get_pool().writer() as conn:
+        conn.executemany('DELETE FROM timers WHERE id = ?', [(timer_id,) for timer_id in timer_ids])
+
+def load_timers(shard_index: int = 0, shard_count: int = 1):
+    # (due, id, action, user_id, payload) по возрастанию due; payload - JSON строка
+    with get_pool().reader() as conn:
+        return conn.execute('''
+            SELECT due, id, action, user_id, payload FROM timers
+            WHERE user_id % ? = ? ORDER BY due
+        ''', (shard_count, shard_index)).fetchall()
+## MARK END: Timers
+
+## MARK: Decay
+# Затухание не пишется в базу каждый час: у питомца хранится last_tick, а
+# накопленное затухание досчитывается при чтении и сохраняется при записи.
+ELAPSED_TICKS = 'MAX(0, (:now - last_tick) / :period)'
+ADVANCED_LAST_TICK = f'last_tick + {ELAPSED_TICKS} * :period'
+
+def _decay_expr(stat: str) -> str:
+    if stat in const.RISING_STATS:
+        return f'MIN(:max_stat, {stat} + {ELAPSED_TICKS} * :rate)'
+    if stat in const.STATS:
+        return f'MAX(:min_stat, {stat} - {ELAPSED_TICKS} * :rate)'
+    return stat
+
+def _decay_params(now: int = None) -> dict:
+    return {
+        'now': int(time.time()) if now is None else now,
+        'period': const.TICK_PERIOD,
+        'rate': const.STAT_DECAY_RATE,
+        'min_stat': const.MIN_STAT,
+        'max_stat': const.MAX_STAT,
+    }
+
+def materialize_decay(pet: dict, now: int = None) -> dict:
+    if pet.get('last_tick') is None:
+        return pet
+    now = int(time.time()) if now is None else now
+    ticks = max(0, (now - pet['last_tick']) // const.TICK_PERIOD)
+    if ticks:
+        for stat in const.STATS:
+            if stat in const.RISING_STATS:
+                pet[stat] = min(const.MAX_STAT, pet[stat] + ticks * const.STAT_DECAY_RATE)
+            else:
+                pet[stat] = max(const.MIN_STAT, pet[stat] - ticks * const.STAT_DECAY_RATE)
+        pet['last_tick'] += ticks * const.TICK_PERIOD
+    return pet
+## MARK END: Decay
+
+## MARK: Tick
+def get_active_user_ids(tick_slot: int, window: int = const.ACTIVE_WINDOW, shard_index: int = 0, shard_count: int = 1):
+    # shard_* - только питомцы своего воркера, то же деление, что у sharding.shard_for
+    since = int(time.time()) - window
+    with get_pool().reader() as conn:
+        return [row[0] for row in conn.execute(f'''
+            SELECT user_id FROM pets
+            WHERE tick_slot = ? AND {ACTIVITY_EXPR} >= ? AND user_id % ? = ?
+        ''', (tick_slot, since, shard_count, shard_index))]
+
+def get_neglected_user_ids(tick_slot: int, idle_for: int, window: int = const.ACTIVE_WINDOW,
+                           shard_index: int = 0, shard_count: int = 1):
+    # Питомцы слота, за которыми не ухаживали дольше idle_for, но не дольше window.
+    # Путь для напоминаний: один диапазон по idx_pets_tick_activity на слот колеса,
+    # как у тика, а не проход по таблице. Последнее действие - самое позднее из
+    # last_*, поэтому с idle_for не меньше кулдауна питомец свободен от всех кулдаунов.
+    now = int(time.time())
+    with get_pool().reader() as conn:
+        return [row[0] for row in conn.execute(f'''
+            SELECT user_id FROM pets
+            WHERE tick_slot = ? AND {ACTIVITY_EXPR} BETWEEN ? AND ? AND user_id % ? = ?
+        ''', (tick_slot, now - window, now - idle_for, shard_count, shard_index))]
+## MARK END: Tick
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from modules.libraries import async_database
+from modules.libraries.database import get_pool
+
+STATE_TTL = 24 * 3600   # брошенная игра живет сутки
+HOT_SIZE = 5000         # ключей в памяти
+PURGE_INTERVAL = 600
+
+class SQLiteStorage(BaseStorage):
+    # FSM хранилище в той же базе, что и питомцы (таблицу fsm создают миграции).
+    # Состояние и данные пишутся сразу (переживают перезапуск), читаются из
+    # небольшого LRU в памяти. У каждой записи есть срок жизни, просроченные
+    # периодически удаляются из базы.
+    def __init__(self, ttl: int = STATE_TTL, hot_size: int = HOT_SIZE, purge_interval: float = PURGE_INTERVAL):
+        self.ttl = ttl
+        self.hot_size = hot_size
+        self.purge_interval = purge_interval
+        self._hot = OrderedDict()  # key -> (state, data, expires)
+        self._purge_task = None
+
+    def start(self):
+        self._purge_task = asyncio.create_task(self._purge_loop())
+
+    async def close(self) -> None:
+        if self._purge_task is not None:
+            self._purge_task.cancel()
+            await asyncio.gather(self._purge_task, return_exceptions=True)
+            self._purge_task = None
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        _, data = await self._load(key)
+        await self._store(key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        state, _ = await self._load(key)
+        await self._store(key, state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(key)
+        return dict(data)
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ':'.join(str(part) if part is not None else '' for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id,
+            getattr(key, 'business_connection_id', None), key.destiny))
+
+    async def _load(self, key: StorageKey):
+        skey = self._key(key)
+        now = int(time.time())
+        entry = self._hot.get(skey)
+        if entry is None:
+            row = await async_database.run_read(self._select, skey)
+            entry = (row[0], json.loads(row[1]) if row[1] else {}, row[2]) if row else (None, {}, None)
+            self._remember(skey, entry)
+        else:
+            self._hot.move_to_end(skey)
+        state, data, expires = entry
+        if expires is not None and expires < now:
+            return None, {}
+        return state, data
+
+    async def _store(self, key: StorageKey, state: Optional[str], data: dict):
+        skey = self._key(key)
+        if state is None and not data:
+            self._remember(skey, (None, {}, None))
+            await async_database.run_write(self._delete, skey)
+            return
+        expires = int(time.time()) + self.ttl
+        self._remember(skey, (state, data, expires))
+        encoded = json.dumps(data, ensure_ascii=False, separators=(',', ':')) if data else None
+        await async_database.run_write(self._upsert, skey, state, encoded, expires)
+
+    def _remember(self, skey: str, entry: tuple):
+        self._hot[skey] = entry
+        self._hot.move_to_end(skey)
+        while len(self._hot) > self.hot_size:
+            self._hot.popitem(last=False)
+
+    @staticmethod
+    def _select(skey: str):
+        with get_pool().reader() as conn:
+            return conn.execute('SELECT state, data, expires FROM fsm WHERE key = ?', (skey,)).fetchone()
+
+    @staticmethod
+    def _upsert(skey: str, state: Optional[str], data: Optional[str], expires: int):
+        with get_pool().writer() as conn:
+            conn.execute('''
+                INSERT INTO fsm (key, state, data, expires) VALUES (?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data, expires = excluded.expires
+            ''', (skey, state, data, expires))
+
+    @staticmethod
+    def _delete(skey: str):
+        with get_pool().writer() as conn:
+            conn.execute('DELETE FROM fsm WHERE key = ?', (skey,))
+
+    @staticmethod
+    def _purge(now: int) -> int:
+        with get_pool().writer() as conn:
+            return conn.execute('DELETE FROM fsm WHERE expires < ?', (now,)).rowcount
+
+    async def _purge_loop(self):
+        while True:
+            await asyncio.sleep(self.purge_interval)
+            now = int(time.time())
+            try:
+                purged = await async_database.run_write(self._purge, now)
+            except Exception:
+                logging.exception("SQLiteStorage >> purge failed")
+                continue
+            self._hot = OrderedDict((k, v) for k, v in self._hot.items() if v[2] is None or v[2] >= now)
+            if purged:
+                logging.info(f"SQLiteStorage >> purged {purged} expired states")
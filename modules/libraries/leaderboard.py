@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import time
+from modules.libraries import async_database, database
+from modules.libraries.constant import const
+from modules.libraries.tricks import MAX_TRICKS, count_tricks
+
+RESYNC_INTERVAL = 3600  # секунд между полными пересборками из базы
+TOP_SIZE = 10
+
+# категория -> (колонка питомца, число возможных значений)
+CATEGORIES = {
+    'intelligence': ('intelligence', const.MAX_STAT + 1),
+    'happiness': ('happiness', const.MAX_STAT + 1),
+    'tricks': ('tricks', MAX_TRICKS + 1),
+    'evolutions': ('evolutions', const.MAX_EVOLUTION_STAGE + 1),
+}
+
+def category_value(category: str, pet) -> int:
+    column, size = CATEGORIES[category]
+    value = pet[column] or 0
+    if category == 'tricks':
+        value = count_tricks(value)
+    return max(0, min(size - 1, value))
+
+class FenwickTree():
+    # Дерево Фенвика над значениями 0..size-1: сколько питомцев с каждым
+    # значением. Изменение и префиксная сумма - O(log size).
+    def __init__(self, size: int):
+        self.size = size
+        self.tree = [0] * (size + 1)
+        self.total = 0
+
+    @classmethod
+    def from_counts(cls, counts: list):
+        # сборка за O(size) вместо size вставок
+        tree = cls(len(counts))
+        tree.tree[1:] = counts
+        for index in range(1, tree.size + 1):
+            parent = index + (index & -index)
+            if parent <= tree.size:
+                tree.tree[parent] += tree.tree[index]
+        tree.total = sum(counts)
+        return tree
+
+    def add(self, value: int, delta: int = 1):
+        self.total += delta
+        index = value + 1
+        while index <= self.size:
+            self.tree[index] += delta
+            index += index & -index
+
+    def count_at_most(self, value: int) -> int:
+        index = min(value + 1, self.size)
+        count = 0
+        while index > 0:
+            count += self.tree[index]
+            index -= index & -index
+        return count
+
+def build(now: int = None):
+    # Выполняется в потоке читателя: по одному GROUP BY на категорию, в Python
+    # приходят только пары (значение, число питомцев)
+    trees = {}
+    for category, (_, size) in CATEGORIES.items():
+        counts = [0] * size
+        for value, count in database.count_leaderboard_values(category, now):
+            counts[max(0, min(size - 1, value or 0))] += count
+        trees[category] = FenwickTree.from_counts(counts)
+    return trees
+
+class Leaderboard():
+    # Места в лидербордах. Для каждой категории - дерево Фенвика по значениям;
+    # место = 1 + число питомцев со значением строго больше. Записи кэша и тика
+    # сразу переносят питомца из старого значения в новое, а раз в
+    # resync_interval деревья пересобираются из базы: так учитываются затухшее
+    # счастье и питомцы других процессов-воркеров.
+    # Сам топ берется из базы по индексам (database.get_top_pets).
+    def __init__(self, resync_interval: float = RESYNC_INTERVAL):
+        self.resync_interval = resync_interval
+        self._trees = {category: FenwickTree(size) for category, (_, size) in CATEGORIES.items()}
+        self._task = None
+        self.resynced_at = None
+        self.resync_seconds = 0.0
+
+    def start(self):
+        # первая сборка идет в фоне и не задерживает запуск бота; до нее rank возвращает None
+        self._task = asyncio.create_task(self._resync_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def resync(self):
+        started = time.perf_counter()
+        # изменения, пришедшие во время сборки, теряются до следующего observe;
+        # база отстает от кэша не больше чем на его интервал сброса
+        self._trees = await async_database.run_read(build)
+        self.resync_seconds = time.perf_counter() - started
+        self.resynced_at = time.time()
+        logging.info(f"Leaderboard >> {self.count()} pets ranked in {self.resync_seconds:.2f}s")
+
+    def observe(self, old, new: dict):
+        # old и new - запись питомца до и после изменения, полные или частичные
+        # (только часть колонок, как у тика); old = None - питомца еще нет в деревьях
+        for category, (column, _) in CATEGORIES.items():
+            if column not in new:
+                continue
+            value = category_value(category, new)
+            if old is not None:
+                if column not in old:
+                    continue
+                previous = category_value(category, old)
+                if previous == value:
+                    continue
+                self._trees[category].add(previous, -1)
+            self._trees[category].add(value)
+
+    def rank(self, category: str, pet):
+        # (место, всего питомцев) по текущим значениям pet или None до первой сборки
+        if self.resynced_at is None:
+            return None
+        tree = self._trees[category]
+        return 1 + tree.total - tree.count_at_most(category_value(category, pet)), tree.total
+
+    def count(self) -> int:
+        return self._trees['intelligence'].total
+
+    async def top(self, category: str, limit: int = TOP_SIZE):
+        return await async_database.get_top_pets(category, limit)
+
+    def stats(self) -> dict:
+        return {
+            'pets': self.count(),
+            'resync_seconds': round(self.resync_seconds, 3),
+        }
+
+    async def _resync_loop(self):
+        while True:
+            try:
+                await self.resync()
+            except Exception:
+                logging.exception("Leaderboard >> resync failed")
+            await asyncio.sleep(self.resync_interval)
+
+leaderboard = Leaderboard()
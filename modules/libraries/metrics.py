@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+from modules.libraries.async_database import current_timings
+
+# верхние границы корзин гистограмм, секунд
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SUMMARY_INTERVAL = 300
+METRICS_PATH = '/metrics'
+
+class Histogram():
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя - +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # верхняя граница корзины, в которую попадает квантиль
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render(self, name: str, labels: str) -> list:
+        lines = []
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {seen}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+class HandlerStats():
+    __slots__ = ('latency', 'errors', 'db_seconds', 'api_seconds')
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = 0
+        self.db_seconds = 0.0
+        self.api_seconds = 0.0
+
+class Metrics():
+    # Счетчики живут в памяти процесса и меняются только из event loop, поэтому
+    # без блокировок; на апдейт - пара perf_counter и bisect по 13 границам.
+    def __init__(self):
+        self.handlers = {}
+        self.api_latency = {}
+        self.api_errors = {}
+        self.gauges = {}
+        self._runner = None
+        self._summary_task = None
+        self._last_summary = {}
+
+    def observe_handler(self, name: str, seconds: float, db_seconds: float, api_seconds: float, failed: bool):
+        stats = self.handlers.get(name)
+        if stats is None:
+            stats = self.handlers[name] = HandlerStats()
+        stats.latency.observe(seconds)
+        stats.db_seconds += db_seconds
+        stats.api_seconds += api_seconds
+        if failed:
+            stats.errors += 1
+
+    def observe_api(self, method: str, seconds: float, failed: bool):
+        histogram = self.api_latency.get(method)
+        if histogram is None:
+            histogram = self.api_latency[method] = Histogram()
+        histogram.observe(seconds)
+        if failed:
+            self.api_errors[method] = self.api_errors.get(method, 0) + 1
+
+    def add_gauges(self, prefix: str, collect):
+        # collect() -> dict; числовые значения выводятся как petpet_<prefix>_<key>
+        self.gauges[prefix] = collect
+
+    def render(self) -> str:
+        lines = [
+            '# HELP petpet_handler_duration_seconds Handler latency.',
+            '# TYPE petpet_handler_duration_seconds histogram',
+        ]
+        for name, stats in self.handlers.items():
+            lines += stats.latency.render('petpet_handler_duration_seconds', f'handler="{name}"')
+        for metric, attribute, text in (('petpet_handler_errors_total', 'errors', 'Handler calls that raised.'),
+                                        ('petpet_handler_db_seconds_total', 'db_seconds', 'Time spent in the database.'),
+                                        ('petpet_handler_api_seconds_total', 'api_seconds', 'Time spent in Bot API calls.')):
+            lines += [f'# HELP {metric} {text}', f'# TYPE {metric} counter']
+            lines += [f'{metric}{{handler="{name}"}} {getattr(stats, attribute):.6g}' for name, stats in self.handlers.items()]
+        lines += ['# HELP petpet_api_duration_seconds Bot API request latency.',
+                  '# TYPE petpet_api_duration_seconds histogram']
+        for method, histogram in self.api_latency.items():
+            lines += histogram.render('petpet_api_duration_seconds', f'method="{method}"')
+        lines += ['# HELP petpet_api_errors_total Bot API requests that failed.', '# TYPE petpet_api_errors_total counter']
+        lines += [f'petpet_api_errors_total{{method="{method}"}} {count}' for method, count in self.api_errors.items()]
+        for prefix, collect in self.gauges.items():
+            for key, value in collect().items():
+                if isinstance(value, (int, float)):
+                    lines += [f'# TYPE petpet_{prefix}_{key} gauge', f'petpet_{prefix}_{key} {value}']
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        # вызовы и ошибки с прошлой сводки, задержки - за все время
+        parts = []
+        for name, stats in sorted(self.handlers.items()):
+            calls, errors = self._last_summary.get(name, (0, 0))
+            self._last_summary[name] = (stats.latency.count, stats.errors)
+            if stats.latency.count == calls:
+                continue
+            count = stats.latency.count
+            parts.append(f"{name}: {count - calls} calls, {stats.errors - errors} errors, "
+                         f"p50<={stats.latency.quantile(0.5)}s p95<={stats.latency.quantile(0.95)}s, "
+                         f"db {stats.db_seconds / count * 1000:.1f}ms api {stats.api_seconds / count * 1000:.1f}ms avg")
+        return '; '.join(parts)
+
+    ## MARK: Serving
+    async def start(self, host: str = '127.0.0.1', port: int = None, summary_interval: float = SUMMARY_INTERVAL):
+        if summary_interval:
+            self._summary_task = asyncio.create_task(self._summary_loop(summary_interval))
+        if port:
+            app = web.Application()
+            app.router.add_get(METRICS_PATH, self.handle)
+            self._runner = web.AppRunner(app)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, host, port).start()
+            logging.info(f"Metrics >> serving on http://{host}:{port}{METRICS_PATH}")
+
+    async def close(self):
+        if self._summary_task is not None:
+            self._summary_task.cancel()
+            await asyncio.gather(self._summary_task, return_exceptions=True)
+            self._summary_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.render(), content_type='text/plain', charset='utf-8')
+
+    async def _summary_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            line = self.summary()
+            if line:
+                logging.info(f"metrics >> {line}")
+    ## MARK END: Serving
+
+metrics = Metrics()
+
+class MetricsMiddleware(BaseMiddleware):
+    # Внутренний middleware: хендлер уже выбран и лежит в data['handler']
+    def __init__(self, registry: Metrics = metrics):
+        self.registry = registry
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object is not None else 'unknown'
+        timings = [0.0, 0.0]
+        token = current_timings.set(timings)
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await handler(event, data)
+            failed = False
+            return result
+        finally:
+            self.registry.observe_handler(name, time.perf_counter() - started, timings[0], timings[1], failed)
+            current_timings.reset(token)
+
+class ApiTimer(BaseRequestMiddleware):
+    # Middleware сессии бота: время каждого запроса к Bot API
+    def __init__(self, registry: Metrics = metrics):
+        self.registry = registry
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await make_request(bot, method)
+            failed = False
+            return result
+        finally:
+            elapsed = time.perf_counter() - started
+            self.registry.observe_api(type(method).__name__, elapsed, failed)
+            timings = current_timings.get()
+            if timings is not None:
+                timings[1] += elapsed
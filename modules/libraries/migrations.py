@@ -0,0 +1,271 @@
+import logging
+import time
+from modules.libraries.constant import const
+from modules.libraries.tricks import TRICKS, TRICK_BITS, COUNT_SQL as TRICKS_COUNT_EXPR
+
+# Версия схемы хранится в PRAGMA user_version. Миграция - функция fn(conn),
+# которая выполняется в одной транзакции с подъемом версии: после падения
+# процесса она либо применена целиком, либо не применена совсем. Большие
+# обновления данных идут до нее, в prepare(pool), кусками по MIGRATION_CHUNK
+# строк в отдельных транзакциях: между кусками писатель свободен и запросы бота
+# не ждут всю миграцию целиком. prepare может выполниться повторно, если процесс
+# упал до подъема версии, поэтому она должна это переносить. Базы, схему которых
+# раньше собирал init_db, проходят все шаги с нуля (IF NOT EXISTS, колонки
+# добавляются только если их нет).
+
+MIGRATION_CHUNK = 10000
+
+# Время последнего действия с питомцем (unix time); тот же текст стоит в индексе
+# idx_pets_tick_activity, иначе SQLite его не применит
+ACTIVITY_EXPR = ('MAX(COALESCE(last_fed, 0), COALESCE(last_cleaned, 0), '
+                 'COALESCE(last_played, 0), COALESCE(last_slept, 0))')
+# Ключ лидерборда по счастью, не зависящий от времени: все питомцы теряют
+# STAT_DECAY_RATE счастья за TICK_PERIOD, поэтому порядок по сохраненному счастью
+# плюс накопленному по last_tick затуханию совпадает с порядком по текущему
+# (с точностью до одного шага и обрезки на нуле). Константы зашиты в индекс.
+HAPPINESS_EXPR = f'happiness + last_tick / {const.TICK_PERIOD} * {const.STAT_DECAY_RATE}'
+# Кандидаты на эволюцию по сохраненным значениям: стадия (evolutions) еще не
+# последняя, падающие статы уже не ниже порога следующей стадии. Затухание их
+# только уменьшает, поэтому фильтр никого не теряет. Тот же текст стоит в условии
+# partial index idx_pets_evolution_stage: при смене констант нужна новая миграция.
+EVOLUTION_FILTER = ' AND '.join(
+    [f'evolutions < {const.MAX_EVOLUTION_STAGE}'] +
+    [f'{stat} >= {const.EVOLUTION_THRESHOLD} + {const.EVOLUTION_STEP} * evolutions'
+     for stat in const.STATS if stat not in const.RISING_STATS])
+TIMESTAMP_COLUMNS = ('last_fed', 'last_cleaned', 'last_played', 'last_slept')
+
+MIGRATIONS = []
+
+def migration(version: int, prepare=None):
+    def register(fn):
+        MIGRATIONS.append((version, prepare, fn))
+        return fn
+    return register
+
+def schema_version(conn) -> int:
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(pool):
+    with pool.writer() as conn:
+        current = schema_version(conn)
+    for version, prepare, fn in sorted(MIGRATIONS, key=lambda item: item[0]):
+        if version <= current:
+            continue
+        started = time.perf_counter()
+        if prepare is not None:
+            prepare(pool)
+        with pool.writer() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            fn(conn)
+            conn.execute(f'PRAGMA user_version = {int(version)}')
+        logging.info(f"migrate >> schema {version} ({fn.__name__}) in {time.perf_counter() - started:.2f}s")
+        current = version
+    return current
+
+def column_type(conn, table: str, column: str) -> str:
+    # объявленный тип; по нему видно, что замена колонок уже прошла в базе,
+    # оставленной сборкой, где версия поднималась отдельно от миграции
+    types = {row[1]: row[2] for row in conn.execute(f'PRAGMA table_info({table})')}
+    return types.get(column, '').upper()
+
+def add_column(conn, table: str, column: str, definition: str):
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def backfill(pool, query: str, params: dict = None, chunk: int = MIGRATION_CHUNK) -> int:
+    # query обновляет строки с user_id в (:lo, :hi]; диапазоны идут по первичному
+    # ключу, поэтому каждый кусок - поиск по индексу, а не проход по таблице
+    params = dict(params or {})
+    lo = -2 ** 63
+    changed = 0
+    while True:
+        with pool.writer() as conn:
+            row = conn.execute('SELECT user_id FROM pets WHERE user_id > ? ORDER BY user_id LIMIT 1 OFFSET ?',
+                               (lo, chunk - 1)).fetchone()
+            hi = row[0] if row else 2 ** 63 - 1
+            changed += conn.execute(query, dict(params, lo=lo, hi=hi)).rowcount
+        if row is None:
+            return changed
+        lo = hi
+        time.sleep(0)
+
+## MARK: Migrations
+@migration(1)
+def create_pets(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS pets (
+            user_id INTEGER PRIMARY KEY,
+            name TEXT,
+            hunger INTEGER DEFAULT 50,
+            cleanliness INTEGER DEFAULT 50,
+            happiness INTEGER DEFAULT 50,
+            energy INTEGER DEFAULT 100,
+            intelligence INTEGER DEFAULT 10,
+            last_fed TEXT,
+            last_cleaned TEXT,
+            last_played TEXT,
+            last_slept TEXT,
+            personality TEXT,
+            favorite_food TEXT,
+            favorite_activity TEXT
+        )
+    ''')
+    # базы первой версии бота создавались без трюков
+    add_column(conn, 'pets', 'tricks', 'TEXT NULL')
+
+def fill_tick_columns(pool):
+    with pool.writer() as conn:
+        add_column(conn, 'pets', 'last_tick', 'INTEGER')
+        add_column(conn, 'pets', 'tick_slot', 'INTEGER')
+    backfill(pool, '''
+        UPDATE pets SET last_tick = COALESCE(last_tick, :now),
+                        tick_slot = user_id % :slots
+        WHERE user_id > :lo AND user_id <= :hi
+          AND (last_tick IS NULL OR tick_slot IS NULL OR tick_slot >= :slots)
+    ''', {'now': int(time.time()), 'slots': const.TICK_SLOTS})
+
+@migration(2, prepare=fill_tick_columns)
+def add_lazy_decay(conn):
+    # колонки добавлены и заполнены в fill_tick_columns, схема больше не меняется
+    pass
+
+@migration(3)
+def create_fsm(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS fsm (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            expires INTEGER
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_fsm_expires ON fsm (expires)')
+
+@migration(4)
+def add_hot_query_indexes(conn):
+    # тик: активные питомцы слота - поиск по слоту и диапазону времени активности
+    # (пока last_* были ISO строками; в версии 5 индекс пересобран под числа)
+    activity = ("MAX(COALESCE(last_fed, ''), COALESCE(last_cleaned, ''), "
+                "COALESCE(last_played, ''), COALESCE(last_slept, ''))")
+    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_pets_tick_activity ON pets (tick_slot, {activity})')
+    conn.execute('DROP INDEX IF EXISTS idx_pets_tick_slot')
+    # лидерборд по интеллекту: он не затухает, так что сохраненное значение точное
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pets_intelligence ON pets (intelligence DESC, user_id)')
+
+def convert_timestamps(pool):
+    # last_* были ISO строками локального времени и разбирались на каждой
+    # проверке кулдауна. Тип колонки в SQLite не меняется, поэтому значения
+    # кусками переносятся в новые INTEGER колонки, а старые тут же очищаются.
+    # Повтор безопасен: уже очищенная строка оставляет перенесенное значение.
+    with pool.writer() as conn:
+        if column_type(conn, 'pets', 'last_fed') == 'INTEGER':
+            return
+        for column in TIMESTAMP_COLUMNS:
+            add_column(conn, 'pets', f'{column}_unix', 'INTEGER')
+        # старый индекс по строкам только замедлил бы перенос
+        conn.execute('DROP INDEX IF EXISTS idx_pets_tick_activity')
+    converted = ', '.join(f"{column}_unix = COALESCE(CAST(strftime('%s', {column}, 'utc') AS INTEGER), {column}_unix), "
+                          f"{column} = NULL" for column in TIMESTAMP_COLUMNS)
+    backfill(pool, f'UPDATE pets SET {converted} WHERE user_id > :lo AND user_id <= :hi')
+    # индекс сразу по новым колонкам: переименование ниже перепишет в нем имена
+    activity = ACTIVITY_EXPR
+    for column in TIMESTAMP_COLUMNS:
+        activity = activity.replace(f'({column},', f'({column}_unix,')
+    with pool.writer() as conn:
+        conn.execute(f'CREATE INDEX idx_pets_tick_activity ON pets (tick_slot, {activity})')
+
+@migration(5, prepare=convert_timestamps)
+def integer_timestamps(conn):
+    # только схема: пустые строковые колонки остаются под именами *_iso,
+    # их удаление переписало бы всю таблицу
+    if column_type(conn, 'pets', 'last_fed') == 'INTEGER':
+        return
+    for column in TIMESTAMP_COLUMNS:
+        conn.execute(f'ALTER TABLE pets RENAME COLUMN {column} TO {column}_iso')
+        conn.execute(f'ALTER TABLE pets RENAME COLUMN {column}_unix TO {column}')
+
+def fill_tricks_mask(pool):
+    # tricks был JSON списком русских названий; переводим в битовую маску по
+    # каталогу tricks.TRICKS. Неизвестные названия и битый JSON дают 0. Список
+    # очищается в том же куске, поэтому повтор не трогает уже перенесенные маски.
+    with pool.writer() as conn:
+        if column_type(conn, 'pets', 'tricks') == 'INTEGER':
+            return
+        add_column(conn, 'pets', 'tricks_mask', 'INTEGER NOT NULL DEFAULT 0')
+    bits = ' '.join(f'WHEN :name{index} THEN {TRICK_BITS[key]}' for index, (key, _) in enumerate(TRICKS))
+    backfill(pool, f'''
+        UPDATE pets SET tricks = NULL, tricks_mask = CASE WHEN json_valid(tricks) THEN
+            CASE WHEN json_type(tricks) = 'array' THEN (
+                SELECT COALESCE(SUM(DISTINCT CASE j.value {bits} ELSE 0 END), 0)
+                FROM json_each(pets.tricks) AS j
+            ) ELSE 0 END ELSE 0 END
+        WHERE user_id > :lo AND user_id <= :hi AND tricks IS NOT NULL
+    ''', {f'name{index}': name for index, (_, name) in enumerate(TRICKS)})
+
+@migration(6, prepare=fill_tricks_mask)
+def tricks_bitmask(conn):
+    # только схема, как в версии 5: пустой список остается под именем tricks_json
+    if column_type(conn, 'pets', 'tricks') == 'INTEGER':
+        return
+    conn.execute('ALTER TABLE pets RENAME COLUMN tricks TO tricks_json')
+    conn.execute('ALTER TABLE pets RENAME COLUMN tricks_mask TO tricks')
+
+@migration(7)
+def create_timers(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS timers (
+            id INTEGER PRIMARY KEY,
+            due REAL NOT NULL,
+            action TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            payload TEXT
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_timers_due ON timers (due)')
+
+@migration(8)
+def add_evolutions(conn):
+    add_column(conn, 'pets', 'evolutions', 'INTEGER NOT NULL DEFAULT 0')
+    # кандидаты на эволюцию по слоту тика. Растущие статы затуханием не портятся,
+    # падающие без затухания должны быть уже не ниже порога, поэтому условие
+    # по сохраненным значениям отсекает почти всех. В версии 10 заменен
+    # индексом idx_pets_evolution_stage с учетом стадии.
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_pets_evolution ON pets (tick_slot)
+        WHERE cleanliness >= 80 AND happiness >= 80
+    ''')
+
+@migration(9)
+def add_leaderboard_indexes(conn):
+    # top-K каждого лидерборда - первые строки своего индекса (интеллект уже есть)
+    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_pets_happiness ON pets ({HAPPINESS_EXPR} DESC, user_id)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_pets_tricks ON pets ({TRICKS_COUNT_EXPR} DESC, user_id)')
+    # у большинства питомцев эволюций нет, они в индекс не попадают
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_pets_evolutions ON pets (evolutions DESC, user_id)
+        WHERE evolutions > 0
+    ''')
+
+def clamp_evolutions(pool):
+    # evolutions стал стадией: не больше MAX_EVOLUTION_STAGE, порог растет с
+    # каждой стадией. Раньше питомец эволюционировал на каждом обороте тика.
+    backfill(pool, '''
+        UPDATE pets SET evolutions = :max_stage
+        WHERE user_id > :lo AND user_id <= :hi AND evolutions > :max_stage
+    ''', {'max_stage': const.MAX_EVOLUTION_STAGE})
+
+@migration(10, prepare=clamp_evolutions)
+def add_evolution_stages(conn):
+    conn.execute('DROP INDEX IF EXISTS idx_pets_evolution')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_pets_evolution_stage ON pets (tick_slot) WHERE {EVOLUTION_FILTER}')
+
+@migration(11)
+def tricks_leaderboard_learned_only(conn):
+    # питомцы без трюков в топ не попадают и, как с эволюциями, не занимают индекс
+    conn.execute('DROP INDEX IF EXISTS idx_pets_tricks')
+    conn.execute(f'''
+        CREATE INDEX IF NOT EXISTS idx_pets_tricks_learned ON pets ({TRICKS_COUNT_EXPR} DESC, user_id)
+        WHERE tricks != 0
+    ''')
+## MARK END: Migrations
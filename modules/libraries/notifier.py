@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramNetworkError, TelegramRetryAfter
+
+WORKERS = 8
+GLOBAL_RATE = 25       # сообщений в секунду на бота, лимит Telegram ~30
+CHAT_RATE = 1.0        # сообщений в секунду в один чат
+CHAT_BURST = 3
+MAX_QUEUE = 10000
+MAX_CHAT_BUCKETS = 10000
+MAX_RETRIES = 3
+LATENCY_WINDOW = 1000
+
+class TokenBucket():
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        # Забирает токен (допуская долг) и возвращает, сколько нужно подождать,
+        # пока он станет доступен. Долг дает честную очередь между воркерами.
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_idle(self) -> bool:
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+class Notifier():
+    # Очередь исходящих сообщений с пулом воркеров. Тик и другие фоновые задачи
+    # кладут сообщения в очередь и не ждут отправки.
+    def __init__(self, bot: Bot, workers: int = WORKERS, global_rate: float = GLOBAL_RATE,
+                 chat_rate: float = CHAT_RATE, chat_burst: int = CHAT_BURST,
+                 max_queue: int = MAX_QUEUE, max_retries: int = MAX_RETRIES):
+        self.bot = bot
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._paused_until = 0.0
+        self._tasks = []
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retried = 0
+        self.max_depth = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self, timeout: float = 10):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Notifier >> {self.queue.qsize()} messages left unsent on shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def enqueue(self, chat_id: int, text: str, **kwargs) -> bool:
+        try:
+            self.queue.put_nowait((chat_id, text, kwargs))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logging.warning(f"Notifier >> queue full, dropped message to {chat_id}")
+            return False
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else 0.0
+        return {
+            'queue_depth': self.queue.qsize(),
+            'max_queue_depth': self.max_depth,
+            'sent': self.sent,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'retried': self.retried,
+            'latency_p50': percentile(0.5),
+            'latency_p95': percentile(0.95),
+            'latency_max': latencies[-1] if latencies else 0.0,
+        }
+
+    async def _wait_for_slot(self, chat_id: int):
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > MAX_CHAT_BUCKETS:
+                self._chat_buckets = {k: v for k, v in self._chat_buckets.items() if not v.is_idle()}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        delay = max(bucket.reserve(), self._global_bucket.reserve())
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _send(self, chat_id: int, text: str, kwargs: dict):
+        for attempt in range(self.max_retries + 1):
+            await self._wait_for_slot(chat_id)
+            started = time.monotonic()
+            try:
+                await self.bot.send_message(chat_id, text, **kwargs)
+            except TelegramRetryAfter as e:
+                # флуд-контроль касается всего бота, тормозим все воркеры
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                self.retried += 1
+                logging.warning(f"Notifier >> flood control, retry after {e.retry_after}s")
+                continue
+            except TelegramNetworkError:
+                self.retried += 1
+                await asyncio.sleep(2 ** attempt)
+                continue
+            except TelegramAPIError as e:
+                self.failed += 1
+                logging.error(f"Failed to send notification to user {chat_id}: {e}")
+                return
+            self.latencies.append(time.monotonic() - started)
+            self.sent += 1
+            return
+        self.failed += 1
+        logging.error(f"Failed to send notification to user {chat_id}: retries exhausted")
+
+    async def _worker(self):
+        while True:
+            chat_id, text, kwargs = await self.queue.get()
+            try:
+                await self._send(chat_id, text, kwargs)
+            except Exception:
+                self.failed += 1
+                logging.exception(f"Failed to send notification to user {chat_id}")
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,53 @@
+import random
+from modules.libraries.constant import const
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Характер -> множители изменений статов; не указанные статы не меняются (1.0)
+PERSONALITIES = {
+    'Игривый': {'happiness': 1.2, 'energy': 1.2, 'intelligence': 0.9},
+    'Ленивый': {'energy': 0.8, 'cleanliness': 1.1, 'intelligence': 1.1},
+    'Любопытный': {'intelligence': 1.2, 'cleanliness': 0.9},
+    'Дружелюбный': {'happiness': 1.2, 'intelligence': 0.9},
+    'Застенчивый': {'happiness': 0.9, 'intelligence': 1.1},
+}
+
+PERSONALITY_NAMES = list(PERSONALITIES)
+PERSONALITY_CODES = {name: code for code, name in enumerate(PERSONALITY_NAMES)}
+# Неизвестный или пустой характер - последняя строка матрицы, из единиц
+NEUTRAL = len(PERSONALITY_NAMES)
+STAT_CODES = {stat: code for code, stat in enumerate(const.NEWSTATS)}
+
+# MULTIPLIERS[код характера][код стата]
+MULTIPLIERS = [[PERSONALITIES[name].get(stat, 1.0) for stat in const.NEWSTATS] for name in PERSONALITY_NAMES] \
+              + [[1.0] * len(const.NEWSTATS)]
+
+# Код характера в SQL, чтобы тик получал строки из одних целых
+CODE_SQL = ('CASE {column} '
+            + ' '.join(f"WHEN '{name}' THEN {code}" for name, code in PERSONALITY_CODES.items())
+            + f' ELSE {NEUTRAL} END')
+
+if np is not None:
+    _MULTIPLIERS = np.array(MULTIPLIERS, dtype=np.float64)
+
+def random_personality() -> str:
+    return random.choice(PERSONALITY_NAMES)
+
+def personality_code(personality: str) -> int:
+    return PERSONALITY_CODES.get(personality, NEUTRAL)
+
+def effect(personality: str, stat: str, value) -> int:
+    code = STAT_CODES.get(stat)
+    if code is None:
+        return round(value)
+    return round(value * MULTIPLIERS[personality_code(personality)][code])
+
+def scale_rows(personality_codes, rows):
+    # rows: n строк изменений по const.NEWSTATS, по строке на питомца
+    if np is not None:
+        return np.rint(np.asarray(rows) * _MULTIPLIERS[np.asarray(personality_codes)]).astype(np.int64)
+    return [[round(value * multiplier) for value, multiplier in zip(row, MULTIPLIERS[personality])]
+            for personality, row in zip(personality_codes, rows)]
@@ -0,0 +1,42 @@
+import asyncio
+import logging
+import time
+
+class TimeWheel():
+    # Колесо таймеров: period делится на slots равных интервалов, каждый интервал
+    # обрабатывается один слот. Дедлайны считаются от начала цикла, а не от конца
+    # предыдущего шага, поэтому время обработки слота не накапливает дрейф и полный
+    # оборот колеса остается равен period.
+    def __init__(self, slots: int, period: float, handler):
+        self.slots = slots
+        self.period = period
+        self.interval = period / slots
+        self.handler = handler
+
+    def current_slot(self) -> int:
+        # привязка к настенным часам: после перезапуска питомец тикает в ту же минуту часа
+        return int(time.time() / self.interval) % self.slots
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        first_slot = self.current_slot()
+        started = loop.time()
+        step = 0
+        while True:
+            slot = (first_slot + step) % self.slots
+            try:
+                await self.handler(slot)
+            except Exception:
+                logging.exception(f"TimeWheel >> slot {slot} failed")
+            step += 1
+            delay = started + step * self.interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif -delay > self.period:
+                # отстали больше чем на полный оборот (например, машина спала):
+                # не догоняем пачкой, а сдвигаем начало цикла
+                logging.warning(f"TimeWheel >> {-delay:.1f}s behind schedule, resetting")
+                started = loop.time() - step * self.interval
+            else:
+                # догоняем без сна, но отдаем управление обработчикам апдейтов
+                await asyncio.sleep(0)
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import multiprocessing
+import time
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+from aiogram.methods import GetUpdates
+from modules.libraries.webhook import extract_user_id
+
+POLLING_TIMEOUT = 30
+JOIN_TIMEOUT = 30
+BACKOFF_MIN = 1   # секунд до повтора getUpdates после ошибки, дальше вдвое больше
+BACKOFF_MAX = 60
+WATCH_INTERVAL = 1  # секунд между проверками, живы ли воркеры
+
+def shard_for(user_id: int, shard_count: int) -> int:
+    return user_id % shard_count if user_id is not None else 0
+
+class Supervisor():
+    # Запускает shard_count процессов-воркеров и раздает им апдейты по user_id:
+    # все апдейты пользователя попадают в один процесс, поэтому его FSM, кэш
+    # питомца и очередь уведомлений остаются локальными для воркера.
+    # worker_target(shard_index, shard_count, queue) должна быть функцией уровня
+    # модуля - процессы стартуют через spawn.
+    def __init__(self, worker_target, shard_count: int):
+        self.worker_target = worker_target
+        self.shard_count = shard_count
+        self._context = multiprocessing.get_context('spawn')
+        self.queues = []
+        self.processes = []
+        self.routed = [0] * shard_count
+        self.restarts = [0] * shard_count
+        self._started_at = [0.0] * shard_count
+        self._restart_delay = [0] * shard_count
+        self._restart_at = [None] * shard_count
+        self._watcher = None
+
+    def start(self):
+        for index in range(self.shard_count):
+            self.queues.append(self._context.Queue())
+            self.processes.append(self._spawn(index))
+        self._watcher = asyncio.create_task(self._watch())
+        logging.info(f"Supervisor >> started {self.shard_count} workers")
+
+    def _spawn(self, index: int):
+        process = self._context.Process(target=self.worker_target,
+                                        args=(index, self.shard_count, self.queues[index]),
+                                        name=f'petpet-worker-{index}')
+        process.start()
+        self._started_at[index] = time.monotonic()
+        return process
+
+    async def _watch(self):
+        # Упавший воркер перезапускается: иначе апдейты его пользователей молча
+        # копились бы в очереди, которую никто не читает. Очередь остается той же,
+        # новый процесс подхватит накопленное. Если воркер падает сразу после
+        # старта, пауза перед перезапуском растет вдвое, до BACKOFF_MAX.
+        while True:
+            await asyncio.sleep(WATCH_INTERVAL)
+            now = time.monotonic()
+            for index, process in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+                if self._restart_at[index] is None:
+                    quick = now - self._started_at[index] < BACKOFF_MAX
+                    delay = min(max(self._restart_delay[index] * 2, BACKOFF_MIN), BACKOFF_MAX) if quick else BACKOFF_MIN
+                    self._restart_delay[index] = delay
+                    self._restart_at[index] = now + delay
+                    logging.error(f"Supervisor >> {process.name} exited with code {process.exitcode}, "
+                                  f"its updates are queued, restarting in {delay}s")
+                elif now >= self._restart_at[index]:
+                    self._restart_at[index] = None
+                    self.restarts[index] += 1
+                    self.processes[index] = self._spawn(index)
+                    logging.warning(f"Supervisor >> {process.name} restarted ({self.restarts[index]} restarts)")
+
+    def route(self, update: dict):
+        shard = shard_for(extract_user_id(update), self.shard_count)
+        self.queues[shard].put(update)
+        self.routed[shard] += 1
+
+    async def feed(self, update: dict):
+        self.route(update)
+
+    async def close(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+            self._watcher = None
+        for queue in self.queues:
+            queue.put(None)
+        loop = asyncio.get_running_loop()
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, JOIN_TIMEOUT)
+            if process.is_alive():
+                logging.warning(f"Supervisor >> {process.name} did not stop, terminating")
+                process.terminate()
+        logging.info(f"Supervisor >> routed per worker: {self.routed}")
+
+    async def poll(self, bot: Bot, allowed_updates=None):
+        # единственный getUpdates на всех воркеров; ошибки сети и Bot API (5xx,
+        # 429 и прочие) повторяются и не роняют супервизора вместе с воркерами
+        offset = None
+        backoff = BACKOFF_MIN
+        while True:
+            try:
+                updates = await bot(GetUpdates(offset=offset, timeout=POLLING_TIMEOUT, allowed_updates=allowed_updates),
+                                    request_timeout=POLLING_TIMEOUT + 10)
+            except TelegramRetryAfter as e:
+                logging.warning(f"Supervisor >> getUpdates flood control, retry in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+                continue
+            except TelegramAPIError as e:
+                logging.warning(f"Supervisor >> getUpdates failed: {e}, retry in {backoff}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, BACKOFF_MAX)
+                continue
+            backoff = BACKOFF_MIN
+            for update in updates:
+                offset = update.update_id + 1
+                self.route(update.model_dump(mode='json', by_alias=True, exclude_none=True))
+
+async def iter_updates(queue):
+    # сторона воркера: апдейты из очереди супервизора до сигнала остановки (None)
+    loop = asyncio.get_running_loop()
+    while True:
+        update = await loop.run_in_executor(None, queue.get)
+        if update is None:
+            return
+        yield update
@@ -0,0 +1,181 @@
+import json
+import logging
+import random
+import time
+from modules.libraries import async_database, tracing
+from modules.libraries.cache import pet_cache
+from modules.libraries.leaderboard import leaderboard
+from modules.libraries.database import get_pool
+from modules.libraries.constant import const
+from modules.libraries.personality import CODE_SQL, NEUTRAL, scale_rows
+
+try:
+    import numpy as np
+except ImportError:
+    # без numpy тик считается тем же алгоритмом построчно
+    np = None
+
+EVENTS = [
+    ("Твой питомец нашел вкусняшку.\nОн насытился и стал немного счастливее!", {'hunger': -10, 'happiness': 10}),
+    ("Твой питомец поиграл с соседским питомцем.\nОн немного устал, но стал счастливее!", {'energy': -10, 'happiness': 15}),
+    ("Твой питомец научился новому трюку.\nОн стал умнее, но устал!", {'intelligence': 10, 'energy': -5}),
+    ("Твой питомец испугался громкого звука.\nЕму стало грустно!", {'happiness': -10, 'energy': 5}),
+    ("Твой питомец поспал на солнышке.\nОн испачкался, но выспался!", {'energy': 15, 'cleanliness': -5}),
+    ("Твой питомец нашел интересную книгу.\nНе поняв ни слова он стал немного умнее и счатливее!", {'intelligence': 15, 'happiness': 5}),
+    ("Твой питомец устроил беспорядок.\nОн испачкался, но стал немного счастливее!", {'cleanliness': -15, 'happiness': 5}),
+    ("Твой питомец помог соседу и получил награду.\nОн устал, но стал счастливее!", {'happiness': 20, 'energy': -10}),
+    ("Твой питомец участвовал в местном конкурсе талантов и выиграл.\nОн стал умнее и счастливее, хоть и устал!", {'intelligence': 10, 'happiness': 15, 'energy': -15}),
+    ("Твой питомец участвовал в местном конкурсе талантов и проиграл.\nЕму стало грустно, так еще и он устал!", {'happiness': -20, 'energy': -15}),
+    ("Твой питомец обнаружил секретный проход в доме.\nЕму стало счастливее!", {'happiness': 25, 'intelligence': 5})
+]
+NO_EVENT = -1
+EVOLUTION_FORMS = ["Супер", "Мега", "Ультра", "Гипер"]
+
+# Матрица эффектов: строка - событие, столбец - стат из const.NEWSTATS. Последняя
+# строка нулевая, поэтому индекс NO_EVENT (-1) дает "без события".
+EFFECTS = [[effect.get(stat, 0) for stat in const.NEWSTATS] for _, effect in EVENTS] + [[0] * len(const.NEWSTATS)]
+# Направление затухания по столбцам: +1 растет, -1 падает, 0 не меняется
+DECAY_SIGNS = [1 if stat in const.RISING_STATS else -1 if stat in const.STATS else 0 for stat in const.NEWSTATS]
+
+# j.key - позиция user_id в переданном массиве, по ней строка находит свое событие;
+# строки приходят в порядке массива
+SELECT_QUERY = (f'SELECT j.key, {CODE_SQL.format(column="p.personality")}, '
+                f'{", ".join(f"p.{stat}" for stat in const.NEWSTATS)}, p.last_tick '
+                'FROM json_each(?) AS j JOIN pets AS p ON p.user_id = j.value')
+UPDATE_QUERY = (f'UPDATE pets SET {", ".join(f"{stat} = ?" for stat in const.NEWSTATS)}, last_tick = ? '
+                'WHERE user_id = ?')
+
+if np is not None:
+    _EFFECTS = np.array(EFFECTS, dtype=np.int64)
+    _DECAY = np.array(DECAY_SIGNS, dtype=np.int64) * const.STAT_DECAY_RATE
+    _rng = np.random.default_rng()
+
+def roll_events(count: int):
+    # Для count активных питомцев: позиции тех, с кем что-то случилось, и номера событий
+    if np is not None:
+        positions = np.flatnonzero(_rng.random(count) < const.EVENT_CHANCE)
+        return positions, _rng.integers(len(EVENTS), size=len(positions))
+    positions = [i for i in range(count) if random.random() < const.EVENT_CHANCE]
+    return positions, [random.randrange(len(EVENTS)) for _ in positions]
+
+def compute_tick(stats, last_tick, event_ids, now: int, personality_codes=None):
+    # stats: n строк по const.NEWSTATS, last_tick: n, event_ids: n (NO_EVENT - без события).
+    # Досчитывает затухание до now, добавляет эффекты событий с учетом характера
+    # и обрезает статы.
+    if personality_codes is None:
+        personality_codes = [NEUTRAL] * len(event_ids)
+    if np is not None:
+        stats = np.asarray(stats, dtype=np.int64)
+        last_tick = np.asarray(last_tick, dtype=np.int64)
+        ticks = np.maximum(0, (now - last_tick) // const.TICK_PERIOD)
+        stats = np.clip(stats + ticks[:, None] * _DECAY, const.MIN_STAT, const.MAX_STAT)
+        effects = scale_rows(personality_codes, _EFFECTS[np.asarray(event_ids)])
+        stats = np.clip(stats + effects, const.MIN_STAT, const.MAX_STAT)
+        return stats, last_tick + ticks * const.TICK_PERIOD
+    new_stats, new_last_tick = [], []
+    effects = scale_rows(personality_codes, [EFFECTS[event_id] for event_id in event_ids])
+    for row, last, effect in zip(stats, last_tick, effects):
+        ticks = max(0, (now - last) // const.TICK_PERIOD)
+        new_stats.append([
+            max(const.MIN_STAT, min(const.MAX_STAT,
+                max(const.MIN_STAT, min(const.MAX_STAT, value + ticks * sign * const.STAT_DECAY_RATE)) + delta))
+            for value, sign, delta in zip(row, DECAY_SIGNS, effect)
+        ])
+        new_last_tick.append(last + ticks * const.TICK_PERIOD)
+    return new_stats, new_last_tick
+
+def apply_events(user_ids, event_ids, now: int = None, written: list = None) -> int:
+    # Читает статы питомцев, считает тик одним пакетом и пишет результат одним
+    # executemany. Чтение внутри транзакции писателя: между ним и записью никто
+    # не успеет изменить этих питомцев. В written, если передан, добавляются
+    # пары (статы до события с затуханием до now, записанная строка: статы по
+    # const.NEWSTATS, last_tick, user_id).
+    # Питомцы идут в порядке user_id, то есть rowid: запись проходит B-дерево
+    # подряд, а не прыгает по страницам, как в порядке индекса активности.
+    if not len(user_ids):
+        return 0
+    now = int(time.time()) if now is None else now
+    if np is not None:
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        order = np.argsort(user_ids)
+        sorted_ids = user_ids[order].tolist()
+    else:
+        user_ids = [int(user_id) for user_id in user_ids]
+        order = sorted(range(len(user_ids)), key=user_ids.__getitem__)
+        sorted_ids = [user_ids[index] for index in order]
+    with get_pool().writer() as conn:
+        rows = conn.execute(SELECT_QUERY, (json.dumps(sorted_ids),)).fetchall()
+        if not rows:
+            return 0
+        if np is not None:
+            data = np.array(rows, dtype=np.int64)
+            positions = order[data[:, 0]]
+            stats, last_tick = compute_tick(data[:, 2:-1], data[:, -1], np.asarray(event_ids)[positions], now, data[:, 1])
+            params = np.column_stack((stats, last_tick, user_ids[positions])).tolist()
+            if written is not None:
+                before, _ = compute_tick(data[:, 2:-1], data[:, -1], np.full(len(data), NO_EVENT), now)
+                written.extend(zip(before.tolist(), params))
+        else:
+            positions = [order[row[0]] for row in rows]
+            stats, last_tick = compute_tick([row[2:-1] for row in rows], [row[-1] for row in rows],
+                                            [event_ids[position] for position in positions], now,
+                                            [row[1] for row in rows])
+            params = [(*row, last, user_ids[position]) for row, last, position in zip(stats, last_tick, positions)]
+            if written is not None:
+                before, _ = compute_tick([row[2:-1] for row in rows], [row[-1] for row in rows], [NO_EVENT] * len(rows), now)
+                written.extend(zip(before, params))
+        conn.executemany(UPDATE_QUERY, params)
+    return len(params)
+
+def notify_user(user_id: int, event: str, notifier):
+    notifier.enqueue(user_id, f"🎉 Событие у твоего питомца!\n\n{event}")
+
+def notify_evolution(user_id: int, name: str, notifier):
+    notifier.enqueue(user_id, f"🎉 Поздравляем! Твой питомец эволюционировал в {name}!")
+
+async def process_tick_slot(notifier, tick_slot: int, cache=pet_cache, board=leaderboard,
+                            shard_index: int = 0, shard_count: int = 1) -> int:
+    # shard_*: в режиме воркеров - только питомцы этого воркера (user_id % shard_count),
+    # чьи записи в кэше принадлежат ему же
+    if tick_slot == 0:
+        logging.info(f"notifier >> {notifier.stats()}")
+        logging.info(f"pet_cache >> {cache.stats()}")
+        if tracing.enabled:
+            logging.info(f"sql >> {tracing.summary()}")
+    # затухание считается лениво (см. database.materialize_decay),
+    # здесь остаются случайные события активных питомцев слота и эволюции
+    events = await process_events(notifier, tick_slot, cache, board, shard_index, shard_count)
+    await process_evolutions(notifier, tick_slot, cache, board, shard_index, shard_count)
+    return events
+
+async def process_events(notifier, tick_slot: int, cache=pet_cache, board=leaderboard,
+                         shard_index: int = 0, shard_count: int = 1) -> int:
+    user_ids = await async_database.get_active_user_ids(tick_slot, shard_index, shard_count)
+    positions, event_ids = roll_events(len(user_ids))
+    if not len(positions):
+        return 0
+    user_ids = [user_ids[position] for position in positions]
+    written = []
+    async with cache.bypass(user_ids):
+        await async_database.run_write(apply_events, user_ids, event_ids, written=written)
+    for before, row in written:
+        board.observe(dict(zip(const.NEWSTATS, before)), dict(zip(const.NEWSTATS, row)))
+    logging.info(f"periodic_update >> slot {tick_slot}: {len(user_ids)} random events")
+    for user_id, event_id in zip(user_ids, event_ids):
+        notify_user(user_id, EVENTS[event_id][0], notifier)
+    return len(user_ids)
+
+async def process_evolutions(notifier, tick_slot: int, cache=pet_cache, board=leaderboard,
+                             shard_index: int = 0, shard_count: int = 1) -> int:
+    # один запрос по partial index на слот вместо проверки на каждом просмотре статуса
+    candidates = await async_database.get_evolution_candidates(tick_slot, shard_index, shard_count)
+    if not candidates:
+        return 0
+    async with cache.bypass(candidates):
+        evolved = await async_database.evolve_pets({user_id: random.choice(EVOLUTION_FORMS) for user_id in candidates})
+    for user_id, name, evolutions in evolved:
+        board.observe({'evolutions': evolutions - 1}, {'evolutions': evolutions})
+        notify_evolution(user_id, name, notifier)
+    if evolved:
+        logging.info(f"periodic_update >> slot {tick_slot}: {len(evolved)} evolutions")
+    return len(evolved)
@@ -0,0 +1,122 @@
+import asyncio
+import heapq
+import json
+import logging
+import time
+from modules.libraries import async_database
+
+MAX_BATCH = 500   # таймеров за один проход планировщика
+MAX_SLEEP = 60    # секунд; перепроверяем кучу, даже если никто не разбудил (сдвиг часов)
+
+ACTIONS = {}
+
+def timer_action(name: str):
+    # действие вызывается как await fn(user_id, payload, notifier)
+    def register(fn):
+        ACTIONS[name] = fn
+        return fn
+    return register
+
+class TimerService():
+    # Отложенные действия: пробуждение питомца, напоминания. Таймер - строка в
+    # таблице timers и кортеж (due, id, action, user_id, payload) в куче; одна
+    # задача спит до ближайшего срока. При старте таймеры своего шарда грузятся
+    # из базы, просроченные срабатывают сразу. Строка удаляется после действия:
+    # при падении процесса действие может повториться, но не потеряется.
+    def __init__(self):
+        self._heap = []
+        self._cancelled = set()
+        self._waiter = None
+        self._task = None
+        self.notifier = None
+        self.fired = 0
+        self.failed = 0
+
+    async def start(self, notifier, shard_index: int = 0, shard_count: int = 1):
+        self.notifier = notifier
+        rows = await async_database.load_timers(shard_index, shard_count)
+        self._heap.extend(rows)
+        heapq.heapify(self._heap)
+        self._task = asyncio.create_task(self._run())
+        logging.info(f"Timers >> {len(rows)} pending timers loaded")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def add(self, delay: float, action: str, user_id: int, payload: dict = None) -> int:
+        if action not in ACTIONS:
+            raise KeyError(f"unknown timer action {action!r}")
+        due = time.time() + delay
+        payload = json.dumps(payload, ensure_ascii=False) if payload is not None else None
+        timer_id = await async_database.add_timer(due, action, user_id, payload)
+        heapq.heappush(self._heap, (due, timer_id, action, user_id, payload))
+        if self._heap[0][1] == timer_id:
+            self._wake()
+        return timer_id
+
+    async def cancel(self, timer_id: int):
+        # из кучи удаляется лениво, когда подойдет срок
+        if any(entry[1] == timer_id for entry in self._heap):
+            self._cancelled.add(timer_id)
+        await async_database.delete_timers([timer_id])
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._heap) - len(self._cancelled),
+            'fired': self.fired,
+            'failed': self.failed,
+        }
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def _sleep(self, delay: float):
+        # сон до срока или до _wake(); без wait_for, который в 3.11 может
+        # проглотить cancel, если ожидание завершилось одновременно с ним
+        loop = asyncio.get_running_loop()
+        self._waiter = loop.create_future()
+        handle = loop.call_later(delay, self._wake)
+        try:
+            await self._waiter
+        finally:
+            handle.cancel()
+            self._waiter = None
+
+    async def _run(self):
+        while True:
+            delay = self._heap[0][0] - time.time() if self._heap else MAX_SLEEP
+            if delay > 0:
+                await self._sleep(min(delay, MAX_SLEEP))
+                continue
+            now = time.time()
+            batch = []
+            while self._heap and self._heap[0][0] <= now and len(batch) < MAX_BATCH:
+                batch.append(heapq.heappop(self._heap))
+            for _, timer_id, action, user_id, payload in batch:
+                if timer_id in self._cancelled:
+                    self._cancelled.discard(timer_id)
+                    continue
+                await self._fire(action, user_id, payload)
+            try:
+                await async_database.delete_timers([entry[1] for entry in batch])
+            except Exception:
+                logging.exception(f"Timers >> failed to delete {len(batch)} fired timers")
+
+    async def _fire(self, action: str, user_id: int, payload: str):
+        fn = ACTIONS.get(action)
+        if fn is None:
+            self.failed += 1
+            logging.warning(f"Timers >> no action {action!r} registered, timer for {user_id} dropped")
+            return
+        try:
+            await fn(user_id, json.loads(payload) if payload else None, self.notifier)
+            self.fired += 1
+        except Exception:
+            self.failed += 1
+            logging.exception(f"Timers >> {action} for {user_id} failed")
+
+timer_service = TimerService()
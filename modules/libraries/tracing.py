@@ -0,0 +1,163 @@
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+# Трассировка SQL, включается через enable() до первого соединения. Каждое
+# выражение через курсор замеряется и складывается в статистику по форме
+# запроса (литералы и параметры заменены на ?). Медленные пишутся в лог
+# petpet.sql.slow вместе с числом параметров, шагами VM и EXPLAIN QUERY PLAN.
+
+SLOW_QUERY_MS = 50
+PROGRESS_STEPS = 1000   # progress handler вызывается раз в столько инструкций VM
+TOP_SHAPES = 10
+
+enabled = False
+slow_query_seconds = SLOW_QUERY_MS / 1000
+slow_log = logging.getLogger('petpet.sql.slow')
+
+_stats = {}         # форма -> QueryStats
+_explained = set()  # формы, для которых план уже записан
+_lock = threading.Lock()
+
+_SHAPE_PATTERNS = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'[:@$]\w+'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)'), '(?, ...)'),
+    (re.compile(r'\s+'), ' '),
+)
+
+def enable(slow_query_ms: float = SLOW_QUERY_MS):
+    global enabled, slow_query_seconds
+    enabled = True
+    slow_query_seconds = slow_query_ms / 1000
+
+def normalize(sql: str) -> str:
+    for pattern, replacement in _SHAPE_PATTERNS:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+class QueryStats():
+    __slots__ = ('count', 'seconds', 'max_seconds', 'rows', 'steps')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+        self.steps = 0
+
+def _record(shape: str, seconds: float, rows: int, steps: int):
+    with _lock:
+        stats = _stats.get(shape)
+        if stats is None:
+            stats = _stats[shape] = QueryStats()
+        stats.count += 1
+        stats.seconds += seconds
+        stats.max_seconds = max(stats.max_seconds, seconds)
+        stats.rows += max(rows, 0)
+        stats.steps += steps
+
+def report(top: int = TOP_SHAPES) -> list:
+    with _lock:
+        items = sorted(_stats.items(), key=lambda item: item[1].seconds, reverse=True)[:top]
+        return [{
+            'shape': shape,
+            'count': stats.count,
+            'total_ms': round(stats.seconds * 1000, 2),
+            'avg_ms': round(stats.seconds / stats.count * 1000, 3),
+            'max_ms': round(stats.max_seconds * 1000, 2),
+            'rows': stats.rows,
+            'vm_steps': stats.steps,
+        } for shape, stats in items]
+
+def summary(top: int = TOP_SHAPES) -> str:
+    return '; '.join(f"{item['count']}x {item['total_ms']}ms (max {item['max_ms']}ms) {item['shape'][:120]}"
+                     for item in report(top))
+
+def reset():
+    with _lock:
+        _stats.clear()
+        _explained.clear()
+
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        return self.connection._traced(super().execute, sql, parameters, False)
+
+    def executemany(self, sql, seq_of_parameters):
+        if not isinstance(seq_of_parameters, (list, tuple)):
+            seq_of_parameters = list(seq_of_parameters)
+        return self.connection._traced(super().executemany, sql, seq_of_parameters, True)
+
+class TracedConnection(sqlite3.Connection):
+    # Фабрика соединений для sqlite3.connect. Connection.execute в C не проходит
+    # через Python-курсор, поэтому execute/executemany переопределены здесь.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._steps = 0
+        self._in_cursor = False
+        self.set_progress_handler(self._progress, PROGRESS_STEPS)
+        self.set_trace_callback(self._trace)
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def _progress(self):
+        self._steps += PROGRESS_STEPS
+        return 0
+
+    def _trace(self, statement: str):
+        # выражения мимо курсора: неявные BEGIN/COMMIT, commit(), PRAGMA при подключении
+        if not self._in_cursor:
+            _record(normalize(statement), 0.0, 0, 0)
+
+    def _traced(self, run, sql: str, parameters, many: bool):
+        self._steps = 0
+        self._in_cursor = True
+        started = time.perf_counter()
+        try:
+            cursor = run(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            self._in_cursor = False
+        steps = self._steps
+        shape = normalize(sql)
+        _record(shape, elapsed, cursor.rowcount, steps)
+        if elapsed >= slow_query_seconds:
+            self._log_slow(sql, shape, parameters, many, elapsed, steps)
+        return cursor
+
+    def _log_slow(self, sql: str, shape: str, parameters, many: bool, elapsed: float, steps: int):
+        if many:
+            bound = f"{len(parameters)} rows x {len(parameters[0]) if parameters else 0} params"
+            sample = parameters[0] if parameters else ()
+        else:
+            bound = f"{len(parameters)} params"
+            sample = parameters
+        plan = ''
+        with _lock:
+            explain = shape not in _explained
+            _explained.add(shape)
+        if explain and sql.lstrip().split(None, 1)[0].upper() in ('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH'):
+            self._in_cursor = True
+            try:
+                rows = sqlite3.Connection.execute(self, f'EXPLAIN QUERY PLAN {sql}', sample).fetchall()
+                plan = ' | '.join(row[-1] for row in rows)
+            except sqlite3.Error as e:
+                plan = f'unavailable: {e}'
+            finally:
+                self._in_cursor = False
+        # SCAN без индекса по обычной таблице; json_each и прочие виртуальные таблицы не в счет
+        full_scan = any(part.startswith('SCAN ') and 'USING' not in part and 'VIRTUAL TABLE' not in part
+                        for part in plan.split(' | '))
+        slow_log.warning(f"{elapsed * 1000:.1f}ms, {bound}, ~{steps} vm steps"
+                         f"{', FULL SCAN' if full_scan else ''}: {shape}"
+                         + (f"\n    plan: {plan}" if plan else ''))
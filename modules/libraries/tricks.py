@@ -0,0 +1,27 @@
+# Каталог трюков. Выученные трюки хранятся в pets.tricks битовой маской:
+# номер бита - позиция трюка в TRICKS. Список можно только дополнять в конец,
+# иначе у сохраненных масок поменяется смысл.
+TRICKS = (
+    ('sit', 'сидеть'),
+    ('roll over', 'перевернуться'),
+    ('fetch', 'принести'),
+    ('speak', 'голос'),
+    ('play dead', 'притвориться мёртвым'),
+)
+MAX_TRICKS = 16  # столько бит считает COUNT_SQL; каталог не должен быть длиннее
+assert len(TRICKS) <= MAX_TRICKS, f"в каталоге {len(TRICKS)} трюков, COUNT_SQL считает только {MAX_TRICKS}"
+# Число выученных трюков в SQL. Длина не зависит от каталога, поэтому индекс
+# по этому выражению не надо пересоздавать при добавлении трюков.
+COUNT_SQL = ' + '.join(f'((tricks >> {bit}) & 1)' for bit in range(MAX_TRICKS))
+TRICK_BITS = {key: 1 << index for index, (key, _) in enumerate(TRICKS)}
+TRICK_NAMES = dict(TRICKS)
+ALL_TRICKS = (1 << len(TRICKS)) - 1
+
+def add_trick(mask: int, key: str) -> int:
+    return (mask or 0) | TRICK_BITS[key]
+
+def count_tricks(mask: int) -> int:
+    return bin((mask or 0) & ALL_TRICKS).count('1')
+
+def missing_tricks(mask: int) -> list:
+    return [key for key, _ in TRICKS if not (mask or 0) & TRICK_BITS[key]]
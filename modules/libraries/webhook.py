@@ -0,0 +1,98 @@
+import asyncio
+import hmac
+import json
+import logging
+from aiohttp import web
+
+MAX_IN_FLIGHT = 100
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+def extract_user_id(update: dict):
+    # апдейт - это update_id и ровно один объект события; у большинства событий
+    # пользователь лежит в 'from', у poll_answer - в 'user'
+    for value in update.values():
+        if isinstance(value, dict):
+            user = value.get('from') or value.get('user')
+            if isinstance(user, dict) and 'id' in user:
+                return user['id']
+    return None
+
+class UpdateProcessor():
+    # Обрабатывает апдейты в фоне: одновременно не больше max_in_flight, апдейты
+    # одного пользователя строго по очереди, разных пользователей - параллельно.
+    def __init__(self, feed, max_in_flight: int = MAX_IN_FLIGHT):
+        self.feed = feed
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._user_locks = {}  # user_id -> [asyncio.Lock, апдейтов в очереди]
+        self._tasks = set()
+
+    async def submit(self, update: dict):
+        # ждет свободного места, если обработчики не успевают
+        await self._semaphore.acquire()
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def close(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _process(self, update: dict):
+        user_id = extract_user_id(update)
+        try:
+            if user_id is None:
+                await self.feed(update)
+            else:
+                entry = self._user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+                entry[1] += 1
+                try:
+                    async with entry[0]:
+                        await self.feed(update)
+                finally:
+                    entry[1] -= 1
+                    if not entry[1]:
+                        del self._user_locks[user_id]
+        except Exception:
+            logging.exception(f"UpdateProcessor >> failed to process update {update.get('update_id')}")
+        finally:
+            self._semaphore.release()
+
+class WebhookServer():
+    # aiohttp сервер для вебхуков Telegram. Апдейт подтверждается сразу и
+    # обрабатывается в фоне через UpdateProcessor; когда заняты все max_in_flight
+    # мест, сервер перестает отвечать и Telegram сам придерживает доставку.
+    def __init__(self, feed, path: str = '/webhook', secret_token: str = None,
+                 max_in_flight: int = MAX_IN_FLIGHT):
+        self.path = path
+        self.secret_token = secret_token
+        self.processor = UpdateProcessor(feed, max_in_flight)
+        self._runner = None
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def start(self, host: str, port: int):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info(f"WebhookServer >> listening on http://{host}:{port}{self.path}")
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        await self.processor.close()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret_token and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret_token):
+            return web.Response(status=401)
+        try:
+            update = await request.json()
+        except (ValueError, json.JSONDecodeError):
+            return web.Response(status=400)
+        if not isinstance(update, dict):
+            return web.Response(status=400)
+        await self.processor.submit(update)
+        return web.Response()